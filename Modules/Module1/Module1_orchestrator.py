@@ -2,18 +2,23 @@
 # Standalone Module-1 Orchestrator (T0 to T1)
 # Skull Strip to Skull QC to N4 to N4 QC to Affine to Affine QC to ANTs SyN to Jacobian
 
+import os
 import time
 import logging
 import argparse
+import multiprocessing
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 
 # ------------------- IMPORT PIPELINES -------------------
 from Modules.Module1.Preprocessing.wrapper_skull_strip import SkullStripper
-from Modules.Module1.Preprocessing.bias_correction import run_bias_correction
+from Modules.Module1.Preprocessing.bias_correction import run_bias_correction, DEFAULT_N4_THREADS
 from Modules.Module1.Preprocessing.affine_register import AffineRegistrationPipeline
 from Modules.Module1.ants_syn import run_ants_syn
 from Modules.Module1.visualize_results import main as generate_jacobian_overlay
+from Modules.nifti_io import decompress_nifti
 
 # ------------------- IMPORT EVALUATORS ------------------
 from Evaluator.Skull_strip_eval import evaluate_clinical_validity
@@ -28,6 +33,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger("MODULE1-APP")
 
+# T0 and T1 N4 run side by side; split the ITK thread budget between them
+N4_THREADS_PER_JOB = max(1, min(DEFAULT_N4_THREADS, os.cpu_count() or 1) // 2)
+
+# ------------------- HELPERS ----------------------------
+def _run_pair(executor: Executor, fn, t0_args: tuple, t1_args: tuple):
+    """Run fn on the independent T0 and T1 inputs concurrently."""
+    t0_future = executor.submit(fn, *t0_args)
+    t1_future = executor.submit(fn, *t1_args)
+    return t0_future.result(), t1_future.result()
+
+
 # ------------------- APP LOGIC --------------------------
 def run_module1(t0_path: Path, t1_path: Path, workdir: Path):
     workdir.mkdir(parents=True, exist_ok=True)
@@ -46,87 +62,115 @@ def run_module1(t0_path: Path, t1_path: Path, workdir: Path):
     logger.info("Starting Module-1 Hybrid Morphometry Engine")
     t_start = time.time()
 
-    with tqdm(total=8, desc="Module-1 Pipeline", unit="step") as pbar:
-
-        # ---------------- STEP 1: SKULL STRIP ----------------
-        pbar.set_description("Skull Stripping (HD-BET)")
-        skull = SkullStripper(logger=logger)
-        t0_brain = skull.run(t0_path, paths["skull"] / "T0")
-        t1_brain = skull.run(t1_path, paths["skull"] / "T1")
-        pbar.update(1)
-
-        # ---------------- STEP 1 QC -------------------------
-        pbar.set_description("Skull Strip QC")
-        evaluate_clinical_validity(t0_brain, paths["qc"])
-        evaluate_clinical_validity(t1_brain, paths["qc"])
-        pbar.update(1)
-
-        # ---------------- STEP 2: N4 -------------------------
-        pbar.set_description("Bias Field Correction (N4)")
-        run_bias_correction(t0_brain, paths["bias"] / "T0")
-        run_bias_correction(t1_brain, paths["bias"] / "T1")
-
-        t0_n4 = next((paths["bias"] / "T0").glob("*_n4.nii.gz"))
-        t1_n4 = next((paths["bias"] / "T1").glob("*_n4.nii.gz"))
-        pbar.update(1)
-
-        # ---------------- STEP 2 QC -------------------------
-        pbar.set_description("N4 QC")
-        evaluate_n4(t0_brain, t0_n4)
-        evaluate_n4(t1_brain, t1_n4)
-        pbar.update(1)
-
-        # ---------------- STEP 3: AFFINE --------------------
-        pbar.set_description("Affine Registration")
-        affine = AffineRegistrationPipeline(
-            fixed_path=t0_n4,
-            moving_path=t1_n4,
-            output_dir=paths["affine"],
-        )
-        affine.run()
-        t1_affine = paths["affine"] / "T1_affine_aligned.nii.gz"
-        pbar.update(1)
-
-        # ---------------- STEP 3 QC -------------------------
-        pbar.set_description("Affine QC")
-        evaluate_affine(t0_n4, t1_affine)
-        pbar.update(1)
+    # ---------------- INPUT DECOMPRESSION ----------------
+    # Every step re-reads T0/T1; unpack the gzip once up front.
+    uncompressed_dir = workdir / "_uncompressed"
+    t0_path = decompress_nifti(t0_path, uncompressed_dir)
+    t1_path = decompress_nifti(t1_path, uncompressed_dir)
+
+    try:
+        # T0 and T1 are independent until registration, so each pair runs
+        # concurrently. HD-BET is an external CPU process (threads suffice);
+        # N4 and the QC metrics are CPU-bound Python (separate processes).
+        # Spawned, not forked: under the API this runs inside a worker that
+        # already holds CUDA state and background threads.
+        with tqdm(total=8, desc="Module-1 Pipeline", unit="step") as pbar, \
+                ThreadPoolExecutor(max_workers=2) as threads, \
+                ProcessPoolExecutor(
+                    max_workers=2, mp_context=multiprocessing.get_context("spawn")
+                ) as procs:
+
+            # ---------------- STEP 1: SKULL STRIP ----------------
+            pbar.set_description("Skull Stripping (HD-BET)")
+            skull = SkullStripper(logger=logger)
+            t0_brain, t1_brain = _run_pair(
+                threads, skull.run,
+                (t0_path, paths["skull"] / "T0"),
+                (t1_path, paths["skull"] / "T1"),
+            )
+            pbar.update(1)
+
+            # ---------------- STEP 1 QC -------------------------
+            pbar.set_description("Skull Strip QC")
+            _run_pair(
+                procs, evaluate_clinical_validity,
+                (t0_brain, paths["qc"]),
+                (t1_brain, paths["qc"]),
+            )
+            pbar.update(1)
+
+            # ---------------- STEP 2: N4 -------------------------
+            pbar.set_description("Bias Field Correction (N4)")
+            t0_n4, t1_n4 = _run_pair(
+                procs, run_bias_correction,
+                (t0_brain, paths["bias"] / "T0", N4_THREADS_PER_JOB),
+                (t1_brain, paths["bias"] / "T1", N4_THREADS_PER_JOB),
+            )
+            pbar.update(1)
+
+            # ---------------- STEP 2 QC -------------------------
+            # Affine does not consume the N4 QC; run it in the background.
+            pbar.set_description("N4 QC + Affine Registration")
+            n4_qc = [
+                procs.submit(evaluate_n4, t0_brain, t0_n4),
+                procs.submit(evaluate_n4, t1_brain, t1_n4),
+            ]
+
+            # ---------------- STEP 3: AFFINE --------------------
+            affine = AffineRegistrationPipeline(
+                fixed_path=t0_n4,
+                moving_path=t1_n4,
+                output_dir=paths["affine"],
+            )
+            affine.run()
+            t1_affine = paths["affine"] / "T1_affine_aligned.nii.gz"
+
+            for future in n4_qc:
+                future.result()
+            pbar.update(2)
+
+            # ---------------- STEP 3 QC -------------------------
+            pbar.set_description("Affine QC")
+            evaluate_affine(t0_n4, t1_affine)
+            pbar.update(1)
         
-        # ---------------- STEP 4: ANTs SyN ------------------
-        pbar.set_description("ANTs SyN + Jacobian")
-        ants_result = run_ants_syn(
-            fixed_path=t0_n4,
-            moving_path=t1_affine,
-            output_dir=paths["ants"],
-        )
+            # ---------------- STEP 4: ANTs SyN ------------------
+            pbar.set_description("ANTs SyN + Jacobian")
+            ants_result = run_ants_syn(
+                fixed_path=t0_n4,
+                moving_path=t1_affine,
+                output_dir=paths["ants"],
+            )
 
-        if not ants_result["qa_pass"]:
-            logger.error("ANTs QA failed — deformation invalid.")
-            raise RuntimeError("Module-1 failed due to invalid deformation field.")
+            if not ants_result["qa_pass"]:
+                logger.error("ANTs QA failed — deformation invalid.")
+                raise RuntimeError("Module-1 failed due to invalid deformation field.")
 
-        pbar.update(1)
+            pbar.update(1)
 
-        # ---------------- STEP 5: JACOBIAN VISUALIZATION ------------------
-        pbar.set_description("Generating Jacobian Overlay Visualization")
+            # ---------------- STEP 5: JACOBIAN VISUALIZATION ------------------
+            pbar.set_description("Generating Jacobian Overlay Visualization")
 
-        warped_t1 = ants_result["warped"]
-        jacobian = ants_result["jacobian"]
+            warped_t1 = ants_result["warped"]
+            jacobian = ants_result["jacobian"]
 
-        viz_dir = workdir / "05_visualization"
-        viz_dir.mkdir(parents=True, exist_ok=True)
+            viz_dir = workdir / "05_visualization"
+            viz_dir.mkdir(parents=True, exist_ok=True)
 
-        overlay_path = viz_dir / "jacobian_overlay.png"
+            overlay_path = viz_dir / "jacobian_overlay.png"
 
-        generate_jacobian_overlay(
-            t0_path=str(t0_n4),
-            warped_t1_path=str(warped_t1),
-            jacobian_path=str(jacobian),
-            out_png=str(overlay_path),
-        )
+            generate_jacobian_overlay(
+                t0_path=str(t0_n4),
+                warped_t1_path=str(warped_t1),
+                jacobian_path=str(jacobian),
+                out_png=str(overlay_path),
+            )
 
-        logger.info(f"Jacobian overlay saved to: {overlay_path}")
+            logger.info(f"Jacobian overlay saved to: {overlay_path}")
 
-        pbar.update(1)
+            pbar.update(1)
+    finally:
+        shutil.rmtree(uncompressed_dir, ignore_errors=True)
 
     # OUTSIDE tqdm block
     elapsed = time.time() - t_start
@@ -94,12 +94,19 @@ def save_visual_report(original_nib, corrected_nib, out_path):
 # ------------------------------------------------------------------
 # Main Pipeline
 # ------------------------------------------------------------------
-def run_bias_correction(input_path: Path, output_dir: Path):
+DEFAULT_N4_THREADS = 20
+
+
+def run_bias_correction(
+    input_path: Path,
+    output_dir: Path,
+    num_threads: int = DEFAULT_N4_THREADS
+) -> Path:
     t0 = time.time()
     
     # 1. Hardware Optimization
-    target_threads = 20
-    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(target_threads)
+    # Callers running several N4 jobs at once pass their share of the budget
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
     
     # Fix: Ensure absolute paths
     input_path = input_path.resolve()
@@ -140,7 +147,7 @@ def run_bias_correction(input_path: Path, output_dir: Path):
         corrector = sitk.N4BiasFieldCorrectionImageFilter()
         corrector.SetMaximumNumberOfIterations([50, 50, 50, 50]) 
         corrector.SetConvergenceThreshold(0.001)
-        corrector.SetNumberOfWorkUnits(target_threads)
+        corrector.SetNumberOfWorkUnits(num_threads)
         pbar.update(1)
         
         # STEP 4: Execute
@@ -169,6 +176,7 @@ def run_bias_correction(input_path: Path, output_dir: Path):
     logger.info(f"  Success. Time: {elapsed:.2f}s")
     logger.info(f"   NIfTI: {out_nifti}")
     logger.info(f"   PNG:   {out_png}")
+    return out_nifti
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
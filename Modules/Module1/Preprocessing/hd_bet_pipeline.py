@@ -6,6 +6,7 @@ import time
 import argparse
 import subprocess
 import logging
+import threading
 from pathlib import Path
 from typing import Optional
 
@@ -16,6 +17,10 @@ import matplotlib
 matplotlib.use('Agg') # <--- ADD THIS LINE
 import torch
 
+# pyplot's current-figure state is process-global; T0 and T1 are
+# stripped on concurrent threads, so their QC plots take turns.
+_QC_PLOT_LOCK = threading.Lock()
+
 
 # ---------------------------------------------------------------------
 # Logging Configuration
@@ -162,20 +167,21 @@ class HDBETPipeline:
         mid_orig = orig_data.shape[0] // 2
         mid_final = final_data.shape[0] // 2
 
-        fig, axes = plt.subplots(1, 2, figsize=(12, 6))
+        with _QC_PLOT_LOCK:
+            fig, axes = plt.subplots(1, 2, figsize=(12, 6))
 
-        # Rotate 90 degrees for better viewing orientation
-        axes[0].imshow(np.rot90(orig_data[mid_orig, :, :]), cmap="gray")
-        axes[0].set_title("Original Input")
-        axes[0].axis("off")
+            # Rotate 90 degrees for better viewing orientation
+            axes[0].imshow(np.rot90(orig_data[mid_orig, :, :]), cmap="gray")
+            axes[0].set_title("Original Input")
+            axes[0].axis("off")
 
-        axes[1].imshow(np.rot90(final_data[mid_final, :, :]), cmap="gray")
-        axes[1].set_title("Skull Stripped & Cropped")
-        axes[1].axis("off")
+            axes[1].imshow(np.rot90(final_data[mid_final, :, :]), cmap="gray")
+            axes[1].set_title("Skull Stripped & Cropped")
+            axes[1].axis("off")
 
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=150)
-        plt.close(fig)
+            plt.tight_layout()
+            plt.savefig(output_path, dpi=150)
+            plt.close(fig)
 
         logger.info(f"QC report saved: {output_path}")
 
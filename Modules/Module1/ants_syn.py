@@ -8,19 +8,16 @@ Includes:
 - Writes full QC JSON
 """
 
+from Modules._ants_env import ITK_THREADS as DEFAULT_ANTS_THREADS
+
 import ants
 import numpy as np
 import nibabel as nib
 import json
-import os
 import shutil
 from pathlib import Path
 from typing import Union
 from datetime import datetime
-import os
-
-DEFAULT_ANTS_THREADS = 18  # Set according to your CPU
-os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(DEFAULT_ANTS_THREADS)
 
 
 PathLike = Union[str, Path]
@@ -46,7 +43,8 @@ def compute_ncc(fixed_np: np.ndarray, warped_np: np.ndarray) -> float:
 def compute_max_displacement(warp_path: PathLike) -> float:
     """Compute maximum displacement magnitude."""
     warp_img = nib.load(_to_str(warp_path))
-    warp = warp_img.get_fdata()
+    # ANTs writes float32 fields; skip get_fdata()'s float64 copy
+    warp = np.asarray(warp_img.dataobj, dtype=np.float32)
 
     if warp.shape[-1] != 3:
         raise ValueError("Warp must contain 3 components.")
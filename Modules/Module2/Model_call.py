@@ -1,14 +1,20 @@
 import os
+import copy
 import time
 import gc
+import hashlib
+import threading
 import torch
 import psutil
 import logging
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from PIL import Image
 from transformers import (
     AutoProcessor,
     AutoModelForImageTextToText,
+    BatchFeature,
     BitsAndBytesConfig,
     StoppingCriteria,
     StoppingCriteriaList,
@@ -18,8 +24,48 @@ from transformers import (
 MODEL_PATH = r"model_store\medgemma-4b-it"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# FlashAttention-2 (fused, tiled attention) when the kernel is installed;
+# otherwise PyTorch SDPA.
+try:
+    import flash_attn  # noqa: F401
+    ATTN_IMPLEMENTATION = "flash_attention_2" if DEVICE == "cuda" else "sdpa"
+except ImportError:
+    ATTN_IMPLEMENTATION = "sdpa"
+
+# Optional JSON-schema constrained decoding for packages that carry a
+# "response_schema" (Stage 4).
+try:
+    from lmformatenforcer import JsonSchemaParser
+    from lmformatenforcer.integrations.transformers import (
+        build_token_enforcer_tokenizer_data,
+        build_transformers_prefix_allowed_tokens_fn
+    )
+except ImportError:
+    JsonSchemaParser = None
+
 STOP_KEYWORDS = ["Disclaimer:", "Note:", "###", "<unused", "Patient Information:"]
 
+# Stages share a long static prompt prefix; its KV cache is kept per image
+# set and reused by the next prompt that starts with the same tokens.
+PREFIX_CACHE_SLOTS = 2
+PREFIX_CACHE_MIN_TOKENS = 64
+
+# Tokenized + preprocessed model inputs, keyed by prompt text and images.
+# Held on the CPU so cached pixel_values never pin VRAM outside the
+# pre-flight budget; a run has four stages, so a handful of slots suffice.
+INPUT_CACHE_SLOTS = 8
+
+# Pre-flight VRAM check: largest budget whose KV cache fits in this share
+# of free memory is tried first.
+VRAM_HEADROOM = 0.85
+# empty_cache() stalls the allocator; only call it when this share of the
+# reserved pool is cached but unused.
+FRAGMENTATION_RATIO = 0.25
+
+# Stages that must repeat exact numbers decode without a repetition penalty
+STRICT_STAGES = ("stage3", "stage4")
+REPETITION_PENALTY = 1.1
+
 STAGE_TOKEN_CAPS = {
     "stage1": 512,
     "stage2": 768,
@@ -32,18 +78,29 @@ STAGE_TOKEN_CAPS = {
 # Utilities
 # ----------------------------------------------------------
 
+_PROC: Optional[psutil.Process] = None
+
+
 def get_ram_mb():
-    return round(psutil.Process(os.getpid()).memory_info().rss / (1024 ** 2), 2)
+    # Rebuilt when the pid changes, so a forked child reports its own RSS
+    global _PROC
+    if _PROC is None or _PROC.pid != os.getpid():
+        _PROC = psutil.Process(os.getpid())
+    return round(_PROC.memory_info().rss / (1024 ** 2), 2)
+
+
+def load_rgb(path) -> Image.Image:
+    return Image.open(path).convert("RGB")
 
 
 def get_gpu_stats():
     if not torch.cuda.is_available():
         return None
-    props = torch.cuda.get_device_properties(0)
+    free, total = torch.cuda.mem_get_info()
     return {
         "allocated_mb": round(torch.cuda.memory_allocated() / (1024 ** 2), 2),
-        "reserved_mb": round(torch.cuda.memory_reserved() / (1024 ** 2), 2),
-        "total_mb": round(props.total_memory / (1024 ** 2), 2),
+        "free_mb": round(free / (1024 ** 2), 2),
+        "total_mb": round(total / (1024 ** 2), 2),
     }
 
 
@@ -51,19 +108,57 @@ def get_gpu_stats():
 # Stopping Criteria
 # ----------------------------------------------------------
 
+def stop_keyword_ids(tokenizer) -> Tuple[List[List[int]], List[str]]:
+    """
+    Token-ID sequences for STOP_KEYWORDS, plus the keywords whose IDs
+    change with the preceding character and so need a text check.
+    """
+    def ids(text):
+        return tokenizer(text, add_special_tokens=False).input_ids
+
+    seqs, unstable = [], []
+    for k in STOP_KEYWORDS:
+        seq = ids(k)
+        seqs.append(seq)
+        if any(ids(prefix + k)[-len(seq):] != seq for prefix in (" ", "\n")):
+            unstable.append(k)
+    return seqs, unstable
+
+
 class NeuroStoppingCriteria(StoppingCriteria):
-    def __init__(self, tokenizer, start_len, min_tokens=40):
+    """
+    Stops on STOP_KEYWORDS by comparing token-ID suffixes each step.
+    Keywords that tokenize differently in context are checked by
+    decoding only the last DECODE_WINDOW tokens.
+
+    Pass precomputed stop_ids (from stop_keyword_ids) to skip
+    tokenizing the keywords.
+    """
+
+    DECODE_WINDOW = 20
+
+    def __init__(self, tokenizer, start_len, min_tokens=40, stop_ids=None):
         self.tokenizer = tokenizer
         self.start_len = start_len
         self.min_tokens = min_tokens
+        self.stop_id_seqs, self.unstable_keywords = stop_ids or stop_keyword_ids(tokenizer)
+        self.max_seq_len = max(len(s) for s in self.stop_id_seqs)
 
     def __call__(self, input_ids, scores, **kwargs):
-        if input_ids.shape[-1] - self.start_len < self.min_tokens:
+        generated = input_ids.shape[-1] - self.start_len
+        if generated < self.min_tokens:
+            return False
+
+        tail = input_ids[0, -self.max_seq_len:].tolist()
+        if any(tail[-len(s):] == s for s in self.stop_id_seqs):
+            return True
+
+        if not self.unstable_keywords:
             return False
         text = self.tokenizer.decode(
-            input_ids[0][self.start_len:], skip_special_tokens=True
+            input_ids[0, -self.DECODE_WINDOW:], skip_special_tokens=True
         )
-        return any(k in text[-50:] for k in STOP_KEYWORDS)
+        return any(k in text for k in self.unstable_keywords)
 
 
 # ----------------------------------------------------------
@@ -72,16 +167,31 @@ class NeuroStoppingCriteria(StoppingCriteria):
 
 class MedGemmaClient:
 
-    def __init__(self, logger: Optional[logging.Logger] = None):
+    def __init__(self, logger: Optional[logging.Logger] = None, stream: bool = False):
         self.logger = logger or logging.getLogger("MedGemmaClient")
         self.model, self.processor = self._load_model()
+        # Console token streaming decodes every step; off unless asked for.
         self.streamer = TextStreamer(
             self.processor.tokenizer,
             skip_prompt=True,
             skip_special_tokens=True
-        )
+        ) if stream else None
+        # Guards the shared caches below against the warmup thread and
+        # any caller sharing this client across threads.
+        self._cache_lock = threading.RLock()
         self.cached_images = None
-        self._warmup()
+        self._cached_image_key: Tuple[str, ...] = ()
+        self._pad_token_id = self.processor.tokenizer.eos_token_id
+        self._stop_ids = stop_keyword_ids(self.processor.tokenizer)
+        self._enforcer_data = None
+        self._input_cache: "OrderedDict[Tuple[bytes, Tuple[str, ...]], Dict[str, torch.Tensor]]" = OrderedDict()
+        self._prefix_cache: "OrderedDict[Tuple[str, ...], Tuple[torch.Tensor, Any]]" = OrderedDict()
+        # Warm up in the background so construction returns immediately;
+        # generate() joins the thread before touching the model.
+        self._warmup_thread = threading.Thread(
+            target=self._warmup, name="medgemma-warmup", daemon=True
+        )
+        self._warmup_thread.start()
 
     # ------------------------------------------------------
 
@@ -89,7 +199,7 @@ class MedGemmaClient:
         if not os.path.exists(MODEL_PATH):
             raise FileNotFoundError(f"Model not found: {MODEL_PATH}")
 
-        self.logger.info("Loading MedGemma (4-bit NF4)...")
+        self.logger.info(f"Loading MedGemma (4-bit NF4, {ATTN_IMPLEMENTATION})...")
 
         bnb_config = BitsAndBytesConfig(
             load_in_4bit=True,
@@ -105,21 +215,39 @@ class MedGemmaClient:
         dtype=torch.bfloat16,
         device_map="auto",
         low_cpu_mem_usage=True,
-        attn_implementation="sdpa"
+        attn_implementation=ATTN_IMPLEMENTATION
     )
 
 
         model.eval()
         return model, processor
 
-    # ------------------------------------------------------
+    def cache_identity(self) -> Dict[str, Any]:
+        """Everything besides the prompt that determines a response."""
+        return {
+            "model_path": MODEL_PATH,
+            "dtype": str(self.model.dtype),
+            "quantization": self.model.config.to_dict().get("quantization_config"),
+            "attn_implementation": ATTN_IMPLEMENTATION,
+            "generation": {
+                "do_sample": False,
+                "stage_token_caps": STAGE_TOKEN_CAPS,
+                "stop_keywords": STOP_KEYWORDS,
+                "repetition_penalty": REPETITION_PENALTY,
+                "strict_stages": STRICT_STAGES,
+                "schema_constrained": JsonSchemaParser is not None
+            }
+        }
 
     def _warmup(self):
-        dummy = self.processor(text="warmup", return_tensors="pt").to(DEVICE)
-        with torch.inference_mode():
-            _ = self.model.generate(**dummy, max_new_tokens=10)
-        if DEVICE == "cuda":
-            torch.cuda.synchronize()
+        try:
+            dummy = self.processor(text="warmup", return_tensors="pt").to(DEVICE)
+            with torch.inference_mode():
+                _ = self.model.generate(**dummy, max_new_tokens=10)
+            if DEVICE == "cuda":
+                torch.cuda.synchronize()
+        except Exception as e:
+            self.logger.warning(f"Warmup failed: {e}")
 
     # ------------------------------------------------------
 
@@ -127,22 +255,35 @@ class MedGemmaClient:
         if not image_paths:
             return None
 
-        if self.cached_images is None:
-            self.cached_images = [
-                Image.open(p).convert("RGB") for p in image_paths
-            ]
+        image_key = tuple(str(p) for p in image_paths)
+        with self._cache_lock:
+            if self.cached_images is None or self._cached_image_key != image_key:
+                # PNG decode releases the GIL; decode all images concurrently.
+                with ThreadPoolExecutor(max_workers=len(image_paths)) as pool:
+                    self.cached_images = list(pool.map(load_rgb, image_paths))
+                self._cached_image_key = image_key
 
-        return self.cached_images
+            return self.cached_images
 
     # ------------------------------------------------------
 
-    def generate(self, prompt_package: Dict[str, Any]) -> str:
-
-        text = prompt_package["text"]
-        stage = prompt_package.get("stage", "stage4")
-        image_paths: List[str] = prompt_package.get("images", [])
-
-        images = self._prepare_images(image_paths)
+    def _build_inputs(self, system: str, text: str, images, image_key: Tuple[str, ...]):
+        """
+        Chat template + processor output for this prompt, on DEVICE.
+        Both are pure functions of the text and images, so the CPU
+        tensors are kept in a small LRU and reused by repeated prompt
+        skeletons; each call gets a fresh BatchFeature on the device
+        (BatchFeature.to() moves in place, so the cached dict never is).
+        """
+        digest = hashlib.blake2b(system.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        key = (digest.digest(), image_key)
+        with self._cache_lock:
+            cached = self._input_cache.get(key)
+            if cached is not None:
+                self._input_cache.move_to_end(key)
+                return BatchFeature({k: v.to(DEVICE) for k, v in cached.items()})
 
         content = []
         if images:
@@ -151,6 +292,9 @@ class MedGemmaClient:
         content.append({"type": "text", "text": text})
 
         messages = [{"role": "user", "content": content}]
+        if system:
+            # Static prefix shared by every stage; leads the prompt tokens.
+            messages.insert(0, {"role": "system", "content": [{"type": "text", "text": system}]})
 
         prompt = self.processor.apply_chat_template(
             messages,
@@ -161,32 +305,173 @@ class MedGemmaClient:
             text=prompt,
             images=images,
             return_tensors="pt"
-        ).to(DEVICE) if images else self.processor(
+        ) if images else self.processor(
             text=prompt,
             return_tensors="pt"
-        ).to(DEVICE)
+        )
+
+        cached = dict(inputs)
+        with self._cache_lock:
+            self._input_cache[key] = cached
+            while len(self._input_cache) > INPUT_CACHE_SLOTS:
+                self._input_cache.popitem(last=False)
+        return BatchFeature({k: v.to(DEVICE) for k, v in cached.items()})
+
+    # ------------------------------------------------------
+
+    def _schema_constraint(self, schema: Optional[Dict[str, Any]]):
+        """prefix_allowed_tokens_fn restricting output to schema, or None."""
+        if not schema or JsonSchemaParser is None:
+            return None
+        with self._cache_lock:
+            if self._enforcer_data is None:
+                # Vocabulary scan; done once per client
+                self._enforcer_data = build_token_enforcer_tokenizer_data(self.processor.tokenizer)
+        return build_transformers_prefix_allowed_tokens_fn(
+            self._enforcer_data, JsonSchemaParser(schema)
+        )
+
+    # ------------------------------------------------------
+
+    def _image_token_id(self) -> Optional[int]:
+        cfg = self.model.config
+        return getattr(cfg, "image_token_id", None) or getattr(cfg, "image_token_index", None)
+
+    def _reuse_prefix_cache(self, image_key: Tuple[str, ...], input_ids: torch.Tensor):
+        """
+        Return a copy of the cached KV state cropped to the prefix this
+        prompt shares with the last prompt for the same images, or None.
+        """
+        # Stored entries are never mutated (reuse deep-copies), so only the
+        # lookup needs the lock.
+        with self._cache_lock:
+            entry = self._prefix_cache.get(image_key)
+        if entry is None:
+            return None
+
+        cached_ids, cached_kv = entry
+        # generate() needs at least one uncached token to start from
+        n = min(cached_ids.shape[0], input_ids.shape[1] - 1)
+        if n <= 0:
+            return None
+        diff = (cached_ids[:n] != input_ids[0, :n]).nonzero()
+        shared = int(diff[0]) if diff.numel() else n
+
+        if shared < PREFIX_CACHE_MIN_TOKENS:
+            return None
+
+        # Image features are only injected on the first forward pass, so the
+        # cached prefix must cover every image token.
+        if image_key:
+            image_token_id = self._image_token_id()
+            if image_token_id is None:
+                return None
+            image_pos = (input_ids[0] == image_token_id).nonzero()
+            if image_pos.numel() and shared <= int(image_pos[-1]):
+                return None
+
+        try:
+            kv = copy.deepcopy(cached_kv)
+            kv.crop(shared)
+        except Exception as e:
+            self.logger.debug(f"Prefix cache not reusable: {e}")
+            return None
+
+        self.logger.debug(f"Reusing KV cache for {shared} prompt tokens")
+        return kv
+
+    def _store_prefix_cache(self, image_key: Tuple[str, ...], input_ids: torch.Tensor, past_key_values):
+        if past_key_values is None:
+            return
+        try:
+            past_key_values.crop(input_ids.shape[1])
+        except Exception as e:
+            self.logger.debug(f"Prefix cache not stored: {e}")
+            return
+
+        with self._cache_lock:
+            self._prefix_cache[image_key] = (input_ids[0].clone(), past_key_values)
+            self._prefix_cache.move_to_end(image_key)
+            while len(self._prefix_cache) > PREFIX_CACHE_SLOTS:
+                self._prefix_cache.popitem(last=False)
+
+    # ------------------------------------------------------
+
+    def _kv_cache_bytes(self, n_tokens: int) -> int:
+        cfg = self.model.config.get_text_config()
+        n_heads = cfg.num_attention_heads
+        n_kv_heads = getattr(cfg, "num_key_value_heads", None) or n_heads
+        head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // n_heads
+        # K and V, bfloat16
+        return 2 * cfg.num_hidden_layers * n_kv_heads * head_dim * n_tokens * 2
+
+    def _plan_budgets(self, budgets: List[int], prompt_len: int) -> List[int]:
+        """
+        Order token budgets so the first attempt is the largest one whose
+        estimated KV cache fits in free VRAM. Smaller budgets stay as the
+        OOM fallback in case the estimate is wrong.
+        """
+        ladder = sorted(set(budgets), reverse=True)
+        if DEVICE != "cuda":
+            return ladder
+
+        free, _ = torch.cuda.mem_get_info()
+        limit = free * VRAM_HEADROOM
+        fitting = [b for b in ladder if self._kv_cache_bytes(prompt_len + b) <= limit]
+
+        if not fitting:
+            self.logger.warning("No token budget fits estimated free VRAM; trying smallest.")
+            return ladder[-1:]
+
+        if fitting[0] != ladder[0]:
+            self.logger.info(f"Pre-flight VRAM check: starting at {fitting[0]} tokens.")
+        return fitting
+
+    def _release_cuda_memory(self):
+        gc.collect()
+        reserved = torch.cuda.memory_reserved()
+        if reserved and (reserved - torch.cuda.memory_allocated()) / reserved > FRAGMENTATION_RATIO:
+            torch.cuda.empty_cache()
+
+    # ------------------------------------------------------
+
+    def generate(self, prompt_package: Dict[str, Any]) -> str:
+
+        self._warmup_thread.join()
+
+        text = prompt_package["text"]
+        system = prompt_package.get("system", "")
+        stage = prompt_package.get("stage", "stage4")
+        image_paths: List[str] = prompt_package.get("images", [])
+
+        images = self._prepare_images(image_paths)
+        image_key = tuple(str(p) for p in image_paths) if images else ()
+
+        inputs = self._build_inputs(system, text, images, image_key)
 
         start_len = inputs["input_ids"].shape[1]
 
         stop_criteria = StoppingCriteriaList([
-            NeuroStoppingCriteria(self.processor.tokenizer, start_len)
+            NeuroStoppingCriteria(
+                self.processor.tokenizer, start_len, stop_ids=self._stop_ids
+            )
         ])
 
         max_tokens = STAGE_TOKEN_CAPS.get(stage, 768)
 
-        budgets = [
+        budgets = self._plan_budgets([
             max_tokens,
             int(max_tokens * 0.75),
             512,
             384,
             256
-        ]
+        ], start_len)
 
         ram_pre = get_ram_mb()
         gpu_pre = get_gpu_stats()
         t0 = time.perf_counter()
 
-        output_ids = None
+        output = None
         # ----------------------------------------------------------
         # FIX: Dynamic Repetition Penalty
         # ----------------------------------------------------------
@@ -194,31 +479,47 @@ class MedGemmaClient:
         # repeat exact numbers. Penalty causes "1.123" to become "1.124".
         # Disable penalty (1.0) for strict stages.
         # ----------------------------------------------------------
-        current_rep_penalty = 1.0 if stage in ["stage3", "stage4"] else 1.1
+        current_rep_penalty = 1.0 if stage in STRICT_STAGES else REPETITION_PENALTY
+
+        sampling_kwargs = {}
+        if self.streamer is not None:
+            sampling_kwargs["streamer"] = self.streamer
+        # Greedy decoding ignores temperature; a penalty of 1.0 is left out
+        # so HF does not install a no-op logits processor.
+        if current_rep_penalty != 1.0:
+            sampling_kwargs["repetition_penalty"] = current_rep_penalty
+        # JSON-schema constrained decoding (Stage 4), when available
+        allowed_tokens_fn = self._schema_constraint(prompt_package.get("response_schema"))
+        if allowed_tokens_fn is not None:
+            sampling_kwargs["prefix_allowed_tokens_fn"] = allowed_tokens_fn
 
         for budget in budgets:
                     try:
                         with torch.inference_mode():
-                            output_ids = self.model.generate(
+                            output = self.model.generate(
                                 **inputs,
+                                past_key_values=self._reuse_prefix_cache(image_key, inputs["input_ids"]),
                                 max_new_tokens=budget,
                                 do_sample=False,
-                                temperature=0.0,
-                                repetition_penalty=current_rep_penalty,  # <--- APPLIED HERE
+                                **sampling_kwargs,  # <--- APPLIED HERE
                                 use_cache=True,
-                                streamer=self.streamer,
+                                return_dict_in_generate=True,
                                 stopping_criteria=stop_criteria,
-                                pad_token_id=self.processor.tokenizer.eos_token_id
+                                pad_token_id=self._pad_token_id
                             )
                         break
                     except torch.cuda.OutOfMemoryError:
                         self.logger.warning(f"OOM at {budget} tokens. Retrying lower.")
-                        torch.cuda.empty_cache()
-                        gc.collect()
+                        with self._cache_lock:
+                            self._prefix_cache.clear()
+                        self._release_cuda_memory()
 
-        if output_ids is None:
+        if output is None:
             raise RuntimeError("All OOM retries failed.")
 
+        output_ids = output.sequences
+        self._store_prefix_cache(image_key, inputs["input_ids"], output.past_key_values)
+
         duration = round(time.perf_counter() - t0, 2)
 
         generated_tokens = output_ids[0][start_len:]
@@ -8,11 +8,15 @@ Now includes Step 6 — Multi-Stage MedGemma Reasoning.
 from asyncio.log import logger
 from pathlib import Path
 import json
+import os
+import shutil
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from Modules.Module2.logger import setup_logger
 from Modules.Module2.step1_register_atlas import register_atlas_to_subject
-from Modules.Module2.step2_roi_extraction import compute_roi_metrics
+from Modules.Module2.step2_roi_extraction import compute_roi_metrics, load_roi_index
 from Modules.Module2.step3_zscore_engine import compute_z_scores
 from Modules.Module2.step4_scoring_engine import classify_progression
 from Modules.Module2.payload_builder import build_intelligence_payload
@@ -27,8 +31,24 @@ from Modules.Module2.Prompts import (
 )
 from Modules.Module2.reasoning_engine import run_multistage_reasoning
 from Modules.Module2.Model_call import MedGemmaClient
+from Modules.nifti_io import decompress_nifti
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Module-level so it is built once and picklable for process pools.
+class PromptWrapper:
+    build_numeric_prompt = staticmethod(build_numeric_prompt)
+    build_multimodal_prompt = staticmethod(build_multimodal_prompt)
+    build_verification_prompt = staticmethod(build_verification_prompt)
+    build_simplification_prompt = staticmethod(build_simplification_prompt)
+
 
 _MEDGEMMA_INSTANCE = None
+_MEDGEMMA_LOCK = threading.Lock()
 # ==========================================================
 # STATIC PATH CONFIGURATION
 # ==========================================================
@@ -52,14 +72,57 @@ SUBCORTICAL_ATLAS_PATH = ATLAS_DIR / "harvard_oxford_subcortical.nii.gz"
 # )
 
 
+# Per-step JSON files duplicate module2_results.json; only written for
+# debugging (DUMP_INTERMEDIATE=1).
+DUMP_INTERMEDIATE = os.getenv("DUMP_INTERMEDIATE") == "1"
+
+
+def _json_default(obj):
+    # Numeric scalars (e.g. numpy) as float, anything else as text
+    try:
+        return float(obj)
+    except (TypeError, ValueError):
+        return str(obj)
+
+
+def _write_json(path: Path, obj):
+    if orjson is not None:
+        path.write_bytes(
+            orjson.dumps(
+                obj,
+                default=_json_default,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            )
+        )
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2, default=_json_default)
+
+
+def _missing_paths(paths):
+    """One directory listing per parent instead of a stat per file."""
+    listings = {}
+    for p in paths:
+        parent = p.parent
+        if parent not in listings:
+            try:
+                with os.scandir(parent) as it:
+                    listings[parent] = {entry.name for entry in it}
+            except OSError:
+                listings[parent] = set()
+        if p.name not in listings[parent]:
+            yield p
+
+
 # ==========================================================
 # MAIN ORCHESTRATION FUNCTION
 # ==========================================================
 def get_medgemma_client(logger):
     global _MEDGEMMA_INSTANCE
-    if _MEDGEMMA_INSTANCE is None:
-        logger.info("Initializing Global MedGemma Client (Singleton)...")
-        _MEDGEMMA_INSTANCE = MedGemmaClient(logger)
+    with _MEDGEMMA_LOCK:
+        if _MEDGEMMA_INSTANCE is None:
+            logger.info("Initializing Global MedGemma Client (Singleton)...")
+            _MEDGEMMA_INSTANCE = MedGemmaClient(logger)
     return _MEDGEMMA_INSTANCE
 
 def run_module2(
@@ -92,12 +155,23 @@ def run_module2(
         NORMATIVE_PATH
     ]
 
-    for p in required_paths:
-        if not p.exists():
-            raise FileNotFoundError(f"Required file not found: {p}")
+    missing = next(_missing_paths(required_paths), None)
+    if missing is not None:
+        raise FileNotFoundError(f"Required file not found: {missing}")
+
+    uncompressed_dir = output_dir / "_uncompressed"
 
     try:
 
+        # ==================================================
+        # INPUT DECOMPRESSION
+        # ==================================================
+        # Volumes are re-read by several steps; unpack the gzip once.
+
+        jacobian_path = decompress_nifti(jacobian_path, uncompressed_dir)
+        t0_path = decompress_nifti(t0_path, uncompressed_dir)
+        t1_followup_path = decompress_nifti(t1_followup_path, uncompressed_dir)
+
         # ==================================================
         # STEP 1
         # ==================================================
@@ -124,17 +198,27 @@ def run_module2(
 
         logger.info("STEP 2 — Computing ROI Metrics")
 
+        # Persisted per session, keyed by atlas checksum: reruns on the
+        # same warped atlases skip the label scan.
+        roi_index = load_roi_index(
+            cortical_subject_path,
+            subcortical_subject_path,
+            ROI_CONFIG_PATH,
+            output_dir / "step2_roi_index"
+        )
+
         step2_result = compute_roi_metrics(
             jacobian_path=jacobian_path,
             cortical_atlas_path=cortical_subject_path,
             subcortical_atlas_path=subcortical_subject_path,
             roi_config_path=ROI_CONFIG_PATH,
             interval_days=interval_days,
-            logger=logger
+            logger=logger,
+            roi_index=roi_index
         )
 
-        with open(output_dir / "step2_roi_metrics.json", "w") as f:
-            json.dump(step2_result, f, indent=4)
+        if DUMP_INTERMEDIATE:
+            _write_json(output_dir / "step2_roi_metrics.json", step2_result)
 
         # ==================================================
         # STEP 3
@@ -149,8 +233,26 @@ def run_module2(
             logger=logger
         )
 
-        with open(output_dir / "step3_z_scores.json", "w") as f:
-            json.dump(step3_result, f, indent=4)
+        if DUMP_INTERMEDIATE:
+            _write_json(output_dir / "step3_z_scores.json", step3_result)
+
+        # ==================================================
+        # STEP 5A (background)
+        # ==================================================
+        # The T1 slice export only needs the follow-up volume, so it
+        # overlaps with Step 4 and is joined before Step 5B.
+
+        logger.info("STEP 5A — Exporting Deterministic T1 Axial Slice")
+
+        t1_png_path = output_dir / "step5_t1_axial_slice.png"
+
+        slice_pool = ThreadPoolExecutor(max_workers=1)
+        slice_future = slice_pool.submit(
+            export_t1_axial_slice,
+            t1_nifti_path=t1_followup_path,
+            output_png_path=t1_png_path
+        )
+        slice_pool.shutdown(wait=False)
 
         # ==================================================
         # STEP 4
@@ -163,21 +265,10 @@ def run_module2(
             logger=logger
         )
 
-        with open(output_dir / "step4_classification.json", "w") as f:
-            json.dump(step4_result, f, indent=4)
-
-        # ==================================================
-        # STEP 5A
-        # ==================================================
-
-        logger.info("STEP 5A — Exporting Deterministic T1 Axial Slice")
-
-        t1_png_path = output_dir / "step5_t1_axial_slice.png"
+        if DUMP_INTERMEDIATE:
+            _write_json(output_dir / "step4_classification.json", step4_result)
 
-        export_t1_axial_slice(
-            t1_nifti_path=t1_followup_path,
-            output_png_path=t1_png_path
-        )
+        slice_future.result()
 
         # ==================================================
         # STEP 5B
@@ -200,8 +291,8 @@ def run_module2(
             logger=logger
         )
 
-        with open(output_dir / "step5_payload.json", "w") as f:
-            json.dump(step5_payload, f, indent=4)
+        if DUMP_INTERMEDIATE:
+            _write_json(output_dir / "step5_payload.json", step5_payload)
 
         # ==================================================
         # STEP 6 — MULTI-STAGE REASONING
@@ -211,21 +302,16 @@ def run_module2(
 
         medgemma = get_medgemma_client(logger) 
 
-        class PromptWrapper:
-            build_numeric_prompt = staticmethod(build_numeric_prompt)
-            build_multimodal_prompt = staticmethod(build_multimodal_prompt)
-            build_verification_prompt = staticmethod(build_verification_prompt)
-            build_simplification_prompt = staticmethod(build_simplification_prompt)
-
         step6_result = run_multistage_reasoning(
             payload=step5_payload,
             prompt_builder=PromptWrapper,
             medgemma_client=medgemma.generate,
-            output_dir=output_dir
+            output_dir=output_dir,
+            model_identity=medgemma.cache_identity()
         )
 
-        with open(output_dir / "step6_reasoning.json", "w") as f:
-            json.dump(step6_result, f, indent=4)
+        if DUMP_INTERMEDIATE:
+            _write_json(output_dir / "step6_reasoning.json", step6_result)
 
         # ==================================================
         # FINAL OUTPUT
@@ -245,8 +331,7 @@ def run_module2(
             "step6_reasoning": step6_result
         }
 
-        with open(output_dir / "module2_results.json", "w") as f:
-            json.dump(final_output, f, indent=4)
+        _write_json(output_dir / "module2_results.json", final_output)
 
         logger.info("Module 2 completed successfully.")
         logger.info("========================================")
@@ -259,6 +344,9 @@ def run_module2(
         logger.error(traceback.format_exc())
         raise
 
+    finally:
+        shutil.rmtree(uncompressed_dir, ignore_errors=True)
+
 # ==========================================================
 # CLI ENTRY
 # ==========================================================
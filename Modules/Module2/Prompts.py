@@ -4,12 +4,25 @@ Implements the "Constrained Intelligence Layer" for Module 2.
 Enforces deterministic numeric handling while allowing rich functional interpretation.
 """
 
+import functools
+import hashlib
 import json
-from typing import Dict, Any
-
-def _constraint_block() -> str:
-    return """
-### SYSTEM ROLE
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+from pydantic import BaseModel, Field
+
+PROMPT_CACHE_SLOTS = 64
+
+# Shared verbatim prefix of every stage prompt, sent as the system turn;
+# built once at import so the identical leading tokens can be served from a
+# prefix (KV) cache.
+#
+# Each stage prompt is laid out static-first: stage header and task
+# instructions come before any patient data, so only the dynamic suffix
+# differs between sessions.
+_CONSTRAINT_BLOCK = """### SYSTEM ROLE
 You are an expert Neuro-Morphometry Analyst assisting in a clinical trial enrichment protocol.
 Your goal is to interpret quantitative brain volume changes (Jacobian determinants) relative to age-matched norms.
 
@@ -18,28 +31,65 @@ Your goal is to interpret quantitative brain volume changes (Jacobian determinan
 2. **NUMERIC INTEGRITY:** Never round, alter, or invent ROI metrics. Copy Annual % Change and Z-scores exactly as they appear.
 3. **NO DIAGNOSIS:** Do not diagnose "Alzheimer's Disease" or "MCI". Use descriptive terms like "neurodegeneration pattern" or "atrophic progression".
 4. **DETERMINISTIC CLASSIFICATION:** You must respect the provided "Fast Progressor" score. Do not re-calculate it.
-5. **FUNCTIONAL FOCUS:** Connect structural changes to their functional implications (e.g., Hippocampus -> Memory), but remain observational.
-"""
+5. **FUNCTIONAL FOCUS:** Connect structural changes to their functional implications (e.g., Hippocampus -> Memory), but remain observational."""
+
+def _memoize_prompt(builder):
+    """
+    Cache a builder's prompt package by the value of its arguments, so a
+    rerun with the same payload (and stage outputs) skips re-rendering.
+    """
+    cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    lock = threading.Lock()
+
+    @functools.wraps(builder)
+    def wrapper(*args):
+        key = hashlib.sha256(
+            json.dumps(args, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        with lock:
+            hit = cache.get(key)
+            if hit is not None:
+                cache.move_to_end(key)
+                return dict(hit)
+
+        package = builder(*args)
+        with lock:
+            cache[key] = package
+            while len(cache) > PROMPT_CACHE_SLOTS:
+                cache.popitem(last=False)
+        return dict(package)
+
+    return wrapper
+
+
+def _format_roi_lines(roi: Dict[str, Any]) -> str:
+    # Format ROI data for clarity
+    return "\n".join([
+        f"- {r.replace('_', ' ').title()}: {val['annual_percent_change']}%/year (Z-Score: {val['z_score']})"
+        for r, val in roi.items()
+    ])
+
 
 # --------------------------------------------------------------------------
 # STAGE 1 — Quantitative Interpretation (Text)
 # Focus: Magnitude assessment and pattern recognition.
 # --------------------------------------------------------------------------
+@_memoize_prompt
 def build_numeric_prompt(payload: Dict[str, Any]) -> Dict[str, Any]:
     roi = payload["roi_metrics"]
     progression = payload["progression"]
     
-    # Format ROI data for clarity
-    roi_text = "\n".join([
-        f"- {r.replace('_', ' ').title()}: {val['annual_percent_change']}%/year (Z-Score: {val['z_score']})"
-        for r, val in roi.items()
-    ])
+    roi_text = _format_roi_lines(roi)
 
     prompt = f"""
-{_constraint_block()}
-
 ### STAGE 1: QUANTITATIVE DATA ANALYSIS
 
+### TASK
+Write a concise analytical summary (plain text) of the data below that:
+1. **Evaluates Severity:** Identify which regions show "significant deviation" (typically Z < -1.5).
+2. **Pattern Recognition:** Is the atrophy global (all regions) or focal (specific regions like Entorhinal Cortex)?
+3. **Progression Context:** Explain why the automated classification (Normal vs. Fast) makes sense based on the numbers provided.
+
 ### PATIENT CONTEXT
 - Age: {payload["metadata"]["age"]}
 - Sex: {payload["metadata"]["sex"]}
@@ -53,46 +103,40 @@ def build_numeric_prompt(payload: Dict[str, Any]) -> Dict[str, Any]:
 - Score: {progression["score"]}
 - Rules Triggered: {'; '.join(progression['rationale'])}
 
-### TASK
-Write a concise analytical summary (plain text) that:
-1. **Evaluates Severity:** Identify which regions show "significant deviation" (typically Z < -1.5).
-2. **Pattern Recognition:** Is the atrophy global (all regions) or focal (specific regions like Entorhinal Cortex)?
-3. **Progression Context:** Explain why the automated classification (Normal vs. Fast) makes sense based on the numbers provided.
-
 ### OUTPUT
 (Provide a 1-paragraph analytical summary).
 """
-    return {"text": prompt, "images": [], "stage": "stage1"}
+    return {"system": _CONSTRAINT_BLOCK, "text": prompt, "images": [], "stage": "stage1"}
 
 
 # --------------------------------------------------------------------------
 # STAGE 2 — Multimodal Integration (Text)
 # Focus: Visual sanity check (Do the numbers match the picture?).
 # --------------------------------------------------------------------------
+@_memoize_prompt
 def build_multimodal_prompt(payload: Dict[str, Any], stage1_output: str) -> Dict[str, Any]:
     prompt = f"""
-{_constraint_block()}
-
 ### STAGE 2: MULTIMODAL VISUAL VALIDATION
 
-### PREVIOUS ANALYSIS (Stage 1)
-"{stage1_output}"
-
 ### VISUAL INPUTS
 1. **Follow-up T1 Slice:** Anatomical reference.
 2. **Jacobian Overlay:** Heatmap of tissue change (Blue/Cool = Atrophy, Red/Warm = Expansion).
 
 ### TASK
-Compare the Quantitative Data from Stage 1 against the Visual Inputs provided here.
+Compare the Quantitative Data from Stage 1 (below) against the Visual Inputs provided here.
 1. **Spatial Concordance:** Does the Jacobian overlay show "cool/blue" colors in the regions where we measured negative Z-scores (e.g., Hippocampus)?
 2. **Artifact Check:** Are there any obvious visual anomalies that contradict the numbers?
 3. **Conclusion:** State whether the visual evidence *supports* or *contradicts* the quantitative metrics.
 
+### PREVIOUS ANALYSIS (Stage 1)
+"{stage1_output}"
+
 ### OUTPUT
 (Provide a short paragraph focusing on visual-numeric alignment).
 """
     # Context images are critical here
     return {
+        "system": _CONSTRAINT_BLOCK,
         "text": prompt, 
         "images": [
             payload["context_images"]["t1_followup_slice"], 
@@ -106,86 +150,129 @@ Compare the Quantitative Data from Stage 1 against the Visual Inputs provided he
 # STAGE 3 — Self Verification (Text)
 # Focus: Error correction before final formatting.
 # --------------------------------------------------------------------------
+@_memoize_prompt
 def build_verification_prompt(payload: Dict[str, Any], stage1_output: str, stage2_output: str) -> Dict[str, Any]:
     prompt = f"""
-{_constraint_block()}
-
 ### STAGE 3: LOGIC & CONSISTENCY CHECK
 
-### INPUTS
-- Stage 1 (Numbers): {stage1_output}
-- Stage 2 (Visuals): {stage2_output}
-
 ### TASK
-Act as a Quality Assurance Auditor. Review the findings above.
+Act as a Quality Assurance Auditor. Review the findings in INPUTS below.
 1. Did the analysis stick to the provided ROI numbers exactly?
 2. Did the analysis avoid diagnosing specific diseases?
 3. Is the functional interpretation logical (e.g., temporal lobe atrophy linked to memory/language)?
 
 If you find any inconsistencies, correct them now. If everything is accurate, summarize the validated clinical narrative.
 
+### INPUTS
+- Stage 1 (Numbers): {stage1_output}
+- Stage 2 (Visuals): {stage2_output}
+
 ### OUTPUT
 (Provide a corrected, finalized narrative summary).
 """
-    return {"text": prompt, "images": [], "stage": "stage3"}
+    return {"system": _CONSTRAINT_BLOCK, "text": prompt, "images": [], "stage": "stage3"}
+
+
+# Stage 4 schema example, serialized once. Numeric values are pre-filled to
+# show the model that "exact copying" is the expected behavior; the
+# classification block is filled per call.
+_SCHEMA_EXAMPLE_TEMPLATE = """{{
+  "roi_interpretations": {{
+    "hippocampus": {{
+      "annual_percent_change": -1.5,
+      "z_score": -0.5,
+      "interpretation": "Brief functional comment on this specific region."
+    }}
+  }},
+  "final_narrative": "A cohesive clinical paragraph summarizing the findings...",
+  "classification": {classification_json},
+  "confidence_level": "High",
+  "warning_flag": null
+}}"""
+
+
+# Stage 4 output contract. Its JSON schema rides on the prompt package as
+# "response_schema"; the client constrains decoding to it when a grammar
+# backend is installed, so the output always parses.
+class ROIInterpretation(BaseModel):
+    annual_percent_change: float
+    z_score: float
+    interpretation: str
+
+
+class ROIInterpretations(BaseModel):
+    hippocampus: ROIInterpretation
+    entorhinal_cortex: ROIInterpretation
+    temporal_lobe: ROIInterpretation
+    parietal_lobe: ROIInterpretation
+    ventricles: ROIInterpretation
+
+
+class Classification(BaseModel):
+    class_: str = Field(alias="class")
+    score: int
+    rationale: List[str]
+
+
+class ClinicalReport(BaseModel):
+    roi_interpretations: ROIInterpretations
+    final_narrative: str
+    classification: Classification
+    confidence_level: str
+    warning_flag: Optional[str] = None
+
+
+_STAGE4_SCHEMA = ClinicalReport.model_json_schema()
 
 
 # --------------------------------------------------------------------------
 # STAGE 4 — Final Clinical Narrative (JSON)
 # Focus: Structured data generation for the pipeline.
 # --------------------------------------------------------------------------
+@_memoize_prompt
 def build_simplification_prompt(payload: Dict[str, Any], stage3_output: str) -> Dict[str, Any]:
     roi = payload["roi_metrics"]
     progression = payload["progression"]
 
-    # Explicit schema definition for the model
-    # Note: We pre-fill the numeric values in the example to show the model 
-    # that "exact copying" is the expected behavior.
-    schema_example = {
-        "roi_interpretations": {
-            "hippocampus": {
-                "annual_percent_change": -1.5,
-                "z_score": -0.5,
-                "interpretation": "Brief functional comment on this specific region."
-            },
-            # ... (repeat for all ROIs)
-        },
-        "final_narrative": "A cohesive clinical paragraph summarizing the findings...",
-        "classification": {
-            "class": progression["class"],
-            "score": progression["score"],
-            "rationale": progression["rationale"]
-        },
-        "confidence_level": "High",
-        "warning_flag": None
-    }
+    # Serialized once; reused for the classification block and the schema example.
+    roi_json = json.dumps(roi, indent=2)
+    cls_json = json.dumps(progression, indent=2)
+    schema_json = _SCHEMA_EXAMPLE_TEMPLATE.format(
+        classification_json=cls_json.replace("\n", "\n  ")
+    )
 
     prompt = f"""
-{_constraint_block()}
-
 ### STAGE 4: FINAL STRUCTURED REPORT GENERATION
 
 ### CONTEXT
 You have validated the data in previous stages. Now, you must format it for the Clinical Trial Database.
 
-### INPUT DATA (Source of Truth)
-{json.dumps(roi, indent=2)}
-
-### VERIFIED NARRATIVE (From Stage 3)
-"{stage3_output}"
-
 ### INSTRUCTIONS
-Generate a JSON object that matches the schema below perfectly.
+Generate a JSON object that matches the JSON SCHEMA EXAMPLE below perfectly.
 1. **ROI Interpretations:** For each ROI, copy the `annual_percent_change` and `z_score` EXACTLY from the Input Data. Write a specific 1-sentence `interpretation` for that region based on the Z-score magnitude.
 2. **Final Narrative:** Synthesize the "Verified Narrative" into a professional clinical summary.
-3. **Classification:** Copy the `classification` object exactly as provided below:
-   {json.dumps(progression, indent=2)}
+3. **Classification:** Copy the `classification` object exactly as provided in CLASSIFICATION below.
 4. **Confidence:** Set to "High" unless visual-numeric mismatch was noted in Stage 2.
 
+### INPUT DATA (Source of Truth)
+{roi_json}
+
+### CLASSIFICATION
+{cls_json}
+
+### VERIFIED NARRATIVE (From Stage 3)
+"{stage3_output}"
+
 ### JSON SCHEMA EXAMPLE
-{json.dumps(schema_example, indent=2)}
+{schema_json}
 
 ### OUTPUT
 Return ONLY the valid JSON object. No markdown formatting, no preambles.
 """
-    return {"text": prompt, "images": [], "stage": "stage4"}
\ No newline at end of file
+    return {
+        "system": _CONSTRAINT_BLOCK,
+        "text": prompt,
+        "images": [],
+        "stage": "stage4",
+        "response_schema": _STAGE4_SCHEMA
+    }
@@ -4,8 +4,13 @@ from pathlib import Path
 
 def inspect(path):
     img = nib.load(str(path))
-    data = img.get_fdata()
-    unique = np.unique(data)
+    data = np.asanyarray(img.dataobj)  # native label dtype, no float64 copy
+
+    if np.issubdtype(data.dtype, np.integer) and data.min() >= 0:
+        counts = np.bincount(data.ravel())
+        unique = np.flatnonzero(counts)
+    else:
+        unique = np.unique(data)
 
     print(f"\nAtlas: {path.name}")
     print(f"Shape: {data.shape}")
@@ -10,6 +10,8 @@ from pathlib import Path
 import logging
 from typing import Dict
 
+import numpy as np
+
 
 REQUIRED_ROIS = [
     "hippocampus",
@@ -89,16 +91,22 @@ def build_intelligence_payload(
 
     interval_years = round(step2_output["interval_years"], 3)
 
-    roi_block = {}
-
-    for roi in REQUIRED_ROIS:
-        annual = step3_output["z_scores"][roi]["annual_percent_change"]
-        z_val = step3_output["z_scores"][roi]["z_score"]
-
-        roi_block[roi] = {
-            "annual_percent_change": round(float(annual), 3),
-            "z_score": round(float(z_val), 3)
+    # Round all ROI values in one vectorized call per field
+    z_scores = step3_output["z_scores"]
+    annual = np.round(np.array(
+        [z_scores[roi]["annual_percent_change"] for roi in REQUIRED_ROIS], dtype=np.float64
+    ), 3).tolist()
+    z_vals = np.round(np.array(
+        [z_scores[roi]["z_score"] for roi in REQUIRED_ROIS], dtype=np.float64
+    ), 3).tolist()
+
+    roi_block = {
+        roi: {
+            "annual_percent_change": apc,
+            "z_score": z
         }
+        for roi, apc, z in zip(REQUIRED_ROIS, annual, z_vals)
+    }
 
     payload = {
         "metadata": {
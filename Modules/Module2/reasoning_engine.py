@@ -4,13 +4,19 @@ Production hardened: structured JSON outputs + repair + deterministic fallback.
 Replaces prior regex-only numeric banning with schema enforcement and fallback.
 """
 
+import bisect
+import hashlib
 import logging
+import os
+import shutil
 import re
 import json
 import math
 from typing import Dict, Any, List, Optional, Union, cast
 from pathlib import Path
 
+import numpy as np
+
 ALLOWED_ROIS = [
     "hippocampus",
     "entorhinal_cortex",
@@ -38,6 +44,32 @@ MISMATCH_TERMS = [
     "anatomical divergence"
 ]
 
+# Single-pass, case-insensitive substring scans over model output.
+_FORBIDDEN_RE = re.compile("|".join(re.escape(t) for t in FORBIDDEN_TERMS), re.IGNORECASE)
+_MISMATCH_RE = re.compile("|".join(re.escape(t) for t in MISMATCH_TERMS), re.IGNORECASE)
+
+# Standalone signed integer or decimal; every match is a valid float
+# literal. Digits glued to letters ("T1"), dotted versions ("1.2.3") and
+# hyphenated words ("1-sentence") are not numbers.
+_NUM_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w-]|\.\d)")
+
+# Numeric claims in free text: decimals, negatives and integers of two or
+# more digits. Single-digit counts ("2 scans"), stage labels ("Stage 2")
+# and tokens glued to letters ("T1", "10th") are not validated; the second
+# bound of a range ("1.5-2.0") is read as positive.
+_CLAIM_RE = re.compile(
+    r"(?<![\w.])(?<![Ss]tage )(?:-?\d+\.\d+|-\d+|\d{2,})(?![\w]|\.\d|-[A-Za-z])"
+)
+
+# Opt-in on-disk response cache (set REASONING_CACHE_DIR): greedy decoding
+# makes each stage a pure function of model + prompt package, so identical
+# payloads on the same model replay stored responses.
+# Layout: {REASONING_CACHE_DIR}/{payload_model_sha}/{stage}_{prompt_sha}.json
+REASONING_CACHE_DIR = (
+    Path(os.environ["REASONING_CACHE_DIR"]) if os.getenv("REASONING_CACHE_DIR") else None
+)
+REASONING_CACHE_MAX_PAYLOADS = 64
+
 MAX_RETRY = 2
 NUMERIC_TOLERANCE = 0.05
 
@@ -81,10 +113,9 @@ def _validate_payload(payload: Dict[str, Any]) -> None:
 
 
 def _check_forbidden_terms(text: str) -> None:
-    lower = text.lower()
-    for term in FORBIDDEN_TERMS:
-        if term in lower:
-            raise ValueError(f"Forbidden medical claim detected: {term}")
+    m = _FORBIDDEN_RE.search(text)
+    if m:
+        raise ValueError(f"Forbidden medical claim detected: {m.group(0).lower()}")
 
 
 def _allowed_numeric_values(payload: Dict[str, Any]) -> List[float]:
@@ -97,99 +128,182 @@ def _allowed_numeric_values(payload: Dict[str, Any]) -> List[float]:
     
     # Include numbers found in progression rationale (thresholds)
     for item in payload["progression"].get("rationale", []):
-        for m in re.findall(r"-?\d+\.?\d+", item):
-            try:
-                allowed.append(float(m))
-            except:
-                pass
+        allowed.extend(float(m) for m in _NUM_RE.findall(item))
     return allowed
 
 
-def _extract_numbers_from_jsonish(obj: Any) -> List[float]:
-    nums = []
+def _build_numeric_context(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Allowed numbers, sorted for bisect, and the exact ROI value strings."""
+    return {
+        "allowed_sorted": sorted(_allowed_numeric_values(payload)),
+        "allowed_strs": {
+            str(payload["roi_metrics"][roi][k])
+            for roi in ALLOWED_ROIS
+            for k in ("annual_percent_change", "z_score")
+        }
+    }
+
+
+def _is_allowed(num: float, allowed_sorted: List[float]) -> bool:
+    # Only the neighbours at the insertion point can be within tolerance.
+    i = bisect.bisect_left(allowed_sorted, num)
+    if i < len(allowed_sorted) and allowed_sorted[i] - num <= NUMERIC_TOLERANCE:
+        return True
+    return i > 0 and num - allowed_sorted[i - 1] <= NUMERIC_TOLERANCE
+
+
+_ROI_NUMERIC_KEYS = ("annual_percent_change", "z_score")
+
+
+def _check_number(num: float, path: tuple, payload: Dict[str, Any], allowed_sorted: List[float]) -> None:
+    # ROI metrics must match their own payload value; everything else only
+    # needs to be one of the allowed numbers.
+    if len(path) == 3 and path[0] == "roi_interpretations" and path[2] in _ROI_NUMERIC_KEYS:
+        roi, nk = path[1], path[2]
+        if roi in ALLOWED_ROIS:
+            payload_val = float(payload["roi_metrics"][roi][nk])
+            if not math.isclose(num, payload_val, rel_tol=0.0, abs_tol=NUMERIC_TOLERANCE):
+                raise ValueError(f"Numeric mismatch for {roi} {nk}: reported {num} vs payload {payload_val}")
+            return
+
+    if not _is_allowed(num, allowed_sorted):
+        raise ValueError(f"Unauthorized numeric value detected: {num}")
+
+
+def _fused_validate(obj: Any, payload: Dict[str, Any], allowed_sorted: List[float], path: tuple = ()) -> None:
+    """
+    One walk over the final JSON: ROI numerics, classification fields and
+    stray numbers are checked as they are reached; raises on the first
+    violation.
+    """
+    if len(path) == 3 and path[0] == "roi_interpretations" and path[2] in _ROI_NUMERIC_KEYS:
+        # ROI metrics must be a number (or numeric string); null, bool or
+        # containers would otherwise slip past the presence-only checks.
+        if isinstance(obj, bool) or not isinstance(obj, (int, float, str)):
+            raise ValueError(f"Non-numeric {path[2]} for ROI {path[1]}: {obj!r}")
+        try:
+            num = float(obj)
+        except ValueError:
+            raise ValueError(f"Non-numeric {path[2]} for ROI {path[1]}: {obj!r}")
+        _check_number(num, path, payload, allowed_sorted)
+        return
+
     if isinstance(obj, dict):
-        for v in obj.values():
-            nums += _extract_numbers_from_jsonish(v)
-    elif isinstance(obj, list):
+        for k, v in obj.items():
+            _fused_validate(v, payload, allowed_sorted, path + (k,))
+        return
+    if isinstance(obj, list):
         for v in obj:
-            nums += _extract_numbers_from_jsonish(v)
-    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
-        nums.append(float(obj))
+            _fused_validate(v, payload, allowed_sorted, path)
+        return
+
+    if path == ("classification", "class"):
+        if str(obj).lower() != payload["progression"]["class"].lower():
+            raise ValueError("Classification text does not match deterministic classification in payload.")
+        return
+    if path == ("classification", "score"):
+        if int(obj) != int(payload["progression"].get("score", 0)):
+            raise ValueError("Classification score mismatch.")
+
+    if isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        _check_number(float(obj), path, payload, allowed_sorted)
     elif isinstance(obj, str):
-        for m in re.findall(r"-?\d+\.?\d+", obj):
-            try:
-                nums.append(float(m))
-            except:
-                pass
-    return nums
-
-
-def _numbers_within_allowed(found_nums: List[float], allowed: List[float]) -> Optional[float]:
-    for num in found_nums:
-        if not any(abs(num - a) <= NUMERIC_TOLERANCE for a in allowed):
-            return num
-    return None
+        for m in _CLAIM_RE.findall(obj):
+            _check_number(float(m), (), payload, allowed_sorted)
 
 
-def _validate_final_json(final_obj: Dict[str, Any], payload: Dict[str, Any]) -> None:
-    # 1) Required top-level keys
+def _validate_final_json(
+    final_obj: Dict[str, Any],
+    payload: Dict[str, Any],
+    allowed_sorted: List[float]
+) -> None:
+    # Structure: presence checks only (no walk)
     for k in ["roi_interpretations", "final_narrative", "classification", "confidence_level"]:
         if k not in final_obj:
             raise ValueError(f"Missing top-level key in final JSON: {k}")
 
-    # 2) ROI keys presence & numeric match
     roi_block = final_obj["roi_interpretations"]
     for roi in ALLOWED_ROIS:
         if roi not in roi_block:
             raise ValueError(f"Missing ROI in final JSON: {roi}")
-        entry = roi_block[roi]
-        for nk in ["annual_percent_change", "z_score"]:
-            if nk not in entry:
+        for nk in _ROI_NUMERIC_KEYS:
+            if nk not in roi_block[roi]:
                 raise ValueError(f"Missing numeric key {nk} for ROI {roi}")
-            
-            payload_val = float(payload["roi_metrics"][roi]["annual_percent_change"]
-                                if nk == "annual_percent_change" else payload["roi_metrics"][roi]["z_score"])
-            
-            if not math.isclose(float(entry[nk]), float(payload_val), rel_tol=0.0, abs_tol=NUMERIC_TOLERANCE):
-                raise ValueError(f"Numeric mismatch for {roi} {nk}: reported {entry[nk]} vs payload {payload_val}")
-
-    # 3) Classification block consistency
+
     cls = final_obj["classification"]
     if "class" not in cls or "score" not in cls or "rationale" not in cls:
         raise ValueError("classification block incomplete")
-    
-    expected_class = payload["progression"]["class"]
-    if cls["class"].lower() != expected_class.lower():
-        raise ValueError("Classification text does not match deterministic classification in payload.")
-    
-    if int(cls["score"]) != int(payload["progression"].get("score", 0)):
-        raise ValueError("Classification score mismatch.")
-
-    # 4) Numeric integrity check for stray numbers
-    allowed = _allowed_numeric_values(payload)
-    found_nums = _extract_numbers_from_jsonish(final_obj)
-    unauthorized = _numbers_within_allowed(found_nums, allowed)
-    if unauthorized is not None:
-        raise ValueError(f"Unauthorized numeric value detected: {unauthorized}")
-
-
-def _extract_json_substring(text: str) -> Optional[str]:
-    start = text.find("{")
-    end = text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        return None
-    candidate = text[start:end+1]
-    stack = []
-    for ch in candidate:
-        if ch == "{":
-            stack.append(1)
-        elif ch == "}":
-            if not stack:
-                return None
-            stack.pop()
-    if stack:
-        return None
-    return candidate
+
+    # Values: single pass over the whole object
+    _fused_validate(final_obj, payload, allowed_sorted)
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """First JSON object embedded in text (preambles/fences tolerated), or None."""
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(text, i)
+            return obj
+        except json.JSONDecodeError:
+            i = text.find("{", i + 1)
+    return None
+
+
+# ---------------------------------------------------------
+# Response cache
+# ---------------------------------------------------------
+def _sha256_json(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _evict_response_cache(cache_root: Path, keep: Path) -> None:
+    # LRU by directory mtime; hits touch their payload directory.
+    entries = sorted(
+        (e for e in os.scandir(cache_root) if e.is_dir()),
+        key=lambda e: e.stat().st_mtime
+    )
+    for e in entries[:max(0, len(entries) - REASONING_CACHE_MAX_PAYLOADS)]:
+        if Path(e.path) != keep:
+            shutil.rmtree(e.path, ignore_errors=True)
+
+
+def _cached_client(
+    medgemma_client: Any,
+    payload: Dict[str, Any],
+    cache_root: Path,
+    model_identity: Optional[Dict[str, Any]],
+    logger: logging.Logger
+) -> Any:
+    # Model path, weights dtype/quantization and generation settings are
+    # part of the key, so a model change never replays old outputs.
+    payload_dir = cache_root / _sha256_json({"payload": payload, "model": model_identity})
+    payload_dir.mkdir(parents=True, exist_ok=True)
+    os.utime(payload_dir)
+    _evict_response_cache(cache_root, keep=payload_dir)
+
+    def call(prompt_package: Dict[str, Any]) -> str:
+        stage = prompt_package.get("stage", "stage4")
+        # Stages 2-4 embed earlier outputs, so key on the full package.
+        path = payload_dir / f"{stage}_{_sha256_json(prompt_package)}.json"
+
+        if path.exists():
+            logger.info(f"{stage} response served from cache.")
+            with open(path) as f:
+                return json.load(f)["response"]
+
+        response = medgemma_client(prompt_package)
+        if isinstance(response, str):
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump({"response": response}, f)
+            os.replace(tmp, path)
+        return response
+
+    return call
 
 
 # ---------------------------------------------------------
@@ -205,10 +319,16 @@ def deterministic_fallback(
     
     logger.info("Using deterministic fallback to generate final JSON (no LLM).")
 
+    roi_metrics = payload["roi_metrics"]
+    apcs = np.round(np.array(
+        [roi_metrics[roi]["annual_percent_change"] for roi in ALLOWED_ROIS], dtype=np.float64
+    ), 3).tolist()
+    zs = np.round(np.array(
+        [roi_metrics[roi]["z_score"] for roi in ALLOWED_ROIS], dtype=np.float64
+    ), 3).tolist()
+
     roi_block = {}
-    for roi in ALLOWED_ROIS:
-        apc = round(float(payload["roi_metrics"][roi]["annual_percent_change"]), 3)
-        z = round(float(payload["roi_metrics"][roi]["z_score"]), 3)
+    for roi, apc, z in zip(ALLOWED_ROIS, apcs, zs):
         interp = f"{roi.replace('_', ' ').title()}: annual change {apc}% per year (Z = {z})."
         roi_block[roi] = {
             "annual_percent_change": apc,
@@ -249,12 +369,15 @@ def _execute_with_retry_json(
     logger: logging.Logger,
     expect_json: bool = False,
     strict: bool = False,
-    stage_trace_texts: Optional[Dict[str, Any]] = None
+    stage_trace_texts: Optional[Dict[str, Any]] = None,
+    ctx: Optional[Dict[str, Any]] = None
 ) -> Union[str, Dict[str, Any]]:
 
     base_prompt = prompt_package["text"]
-    images = prompt_package.get("images", [])
-    stage = prompt_package.get("stage", "stage4")
+
+    # Same payload on every attempt and stage; built once per run.
+    ctx = ctx or _build_numeric_context(payload)
+    allowed_sorted = ctx["allowed_sorted"]
 
     for attempt in range(MAX_RETRY + 1):
         logger.info(f"{stage_name} — Attempt {attempt+1}")
@@ -263,7 +386,7 @@ def _execute_with_retry_json(
         if not isinstance(response, str):
             raise ValueError("Model response must be string.")
 
-        logger.debug(f"{stage_name} raw output:\n{response}")
+        logger.debug("%s raw output:\n%s", stage_name, response)
 
         try:
             _check_forbidden_terms(response)
@@ -271,30 +394,20 @@ def _execute_with_retry_json(
             # --- TEXT MODE (Stages 1-3) ---
             if not expect_json:
                 if strict:
-                    for roi in ALLOWED_ROIS:
-                        apc = str(payload["roi_metrics"][roi]["annual_percent_change"])
-                        z = str(payload["roi_metrics"][roi]["z_score"])
-                        if apc not in response or z not in response:
-                            raise ValueError(f"Missing numeric value in text output for ROI {roi}.")
+                    # One regex sweep, then a set difference
+                    missing = ctx["allowed_strs"] - set(_NUM_RE.findall(response))
+                    if missing:
+                        raise ValueError(f"Missing numeric values in text output: {sorted(missing)}")
                 logger.info(f"{stage_name} passed validation (non-JSON).")
                 return response
 
             # --- JSON MODE (Stage 4) ---
-            parsed = None
-            try:
-                parsed = json.loads(response)
-            except Exception:
-                candidate = _extract_json_substring(response)
-                if candidate:
-                    try:
-                        parsed = json.loads(candidate)
-                    except Exception:
-                        parsed = None
+            parsed = _extract_json_object(response)
 
             if parsed is None:
                 raise ValueError("Model output is not valid JSON.")
 
-            _validate_final_json(parsed, payload)
+            _validate_final_json(parsed, payload, allowed_sorted)
 
             parsed["repair_attempted"] = attempt > 0
             parsed["fallback_used"] = False
@@ -325,11 +438,8 @@ def _execute_with_retry_json(
                 + "3) Do NOT include forbidden medical claims.\n"
             )
 
-            prompt_package = {
-                "text": corrected_prompt,
-                "images": images,
-                "stage": stage
-            }
+            # Keep the system prefix and any other package fields
+            prompt_package = {**prompt_package, "text": corrected_prompt}
 
     raise RuntimeError("Unexpected control flow.")
 
@@ -341,49 +451,44 @@ def run_multistage_reasoning(
     payload: Dict[str, Any],
     prompt_builder: Any,
     medgemma_client: Any,
-    output_dir: Path
+    output_dir: Path,
+    cache_dir: Optional[Path] = REASONING_CACHE_DIR,
+    model_identity: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
 
     logger = setup_reasoning_logger(output_dir)
     logger.info("========== Starting Step 6 Reasoning ==========")
 
     _validate_payload(payload)
+    ctx = _build_numeric_context(payload)
+
+    if cache_dir is not None:
+        medgemma_client = _cached_client(medgemma_client, payload, cache_dir, model_identity, logger)
+
+    def run_text_stage(stage_name: str, pkg: Dict[str, Any]) -> str:
+        return cast(str, _execute_with_retry_json(
+            stage_name,
+            pkg,
+            medgemma_client,
+            payload,
+            logger,
+            expect_json=False,
+            strict=False,
+            ctx=ctx
+        ))
 
     # Stage 1 — Quantitative Interpretation (Returns String)
     stage1_pkg = prompt_builder.build_numeric_prompt(payload)
-    stage1_text = cast(str, _execute_with_retry_json(
-        "Stage 1 — Quantitative Interpretation",
-        stage1_pkg,
-        medgemma_client,
-        payload,
-        logger,
-        expect_json=False,
-        strict=False
-    ))
+
+    stage1_text = run_text_stage("Stage 1 — Quantitative Interpretation", stage1_pkg)
 
     # Stage 2 — Multimodal Integration (Returns String)
     stage2_pkg = prompt_builder.build_multimodal_prompt(payload, stage1_text)
-    stage2_text = cast(str, _execute_with_retry_json(
-        "Stage 2 — Multimodal Integration",
-        stage2_pkg,
-        medgemma_client,
-        payload,
-        logger,
-        expect_json=False,
-        strict=False
-    ))
+    stage2_text = run_text_stage("Stage 2 — Multimodal Integration", stage2_pkg)
 
     # Stage 3 — Self Verification (Returns String)
     stage3_pkg = prompt_builder.build_verification_prompt(payload, stage1_text, stage2_text)
-    stage3_text = cast(str, _execute_with_retry_json(
-        "Stage 3 — Self Verification",
-        stage3_pkg,
-        medgemma_client,
-        payload,
-        logger,
-        expect_json=False,
-        strict=False
-    ))
+    stage3_text = run_text_stage("Stage 3 — Self Verification", stage3_pkg)
 
     # Stage 4 — Final Clinical Narrative (Returns Dictionary)
     stage4_pkg = prompt_builder.build_simplification_prompt(payload, stage3_text)
@@ -401,7 +506,8 @@ def run_multistage_reasoning(
         logger,
         expect_json=True,
         strict=True,
-        stage_trace_texts=stage_trace_texts
+        stage_trace_texts=stage_trace_texts,
+        ctx=ctx
     ))
 
     # Consistency Check (Redundant safety check)
@@ -412,10 +518,9 @@ def run_multistage_reasoning(
             raise ValueError("Final JSON classification mismatch AFTER repair.")
 
     # Downgrade confidence if visual mismatch detected
-    lower_s2 = stage2_text.lower()
     warning_flag = final_json.get("warning_flag", None)
     
-    if any(term in lower_s2 for term in MISMATCH_TERMS) and (warning_flag is None):
+    if _MISMATCH_RE.search(stage2_text) and (warning_flag is None):
         final_json["warning_flag"] = "Visual-Numeric Mismatch"
         final_json["confidence_level"] = "Low (Visual Mismatch)"
 
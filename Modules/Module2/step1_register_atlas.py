@@ -2,11 +2,19 @@
 STEP 1 — Register MNI Template to Subject (Fast, Nonlinear)
 Then Warp Atlas Labels to Subject Space
 
-Uses antsRegistrationSyNQuick[s] for speed.
+Affine + SyN with Mattes MI, registered at 2 mm with short
+per-level schedules; atlas labels only need coarse warps.
 Designed for Module 2 ROI extraction.
+
+Set NEURO_USE_FIREANTS=1 to run the registration on the GPU with
+FireANTs when it and CUDA are available; atlas warping stays in ANTs.
 """
 
+from Modules._ants_env import ITK_THREADS as DEFAULT_THREADS
+
 import ants
+import functools
+import numpy as np
 import os
 import shutil
 from pathlib import Path
@@ -17,8 +25,157 @@ import time
 # -----------------------------
 # CONFIG
 # -----------------------------
-DEFAULT_THREADS = 16
-os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(DEFAULT_THREADS)
+REGISTRATION_SPACING_MM = (2.0, 2.0, 2.0)
+
+REGISTRATION_PARAMS = dict(
+    type_of_transform="SyN",
+    aff_metric="mattes",
+    aff_sampling=32,
+    aff_iterations=(500, 250, 100),
+    aff_shrink_factors=(4, 2, 1),
+    aff_smoothing_sigmas=(4, 2, 0),
+    syn_metric="mattes",
+    syn_sampling=32,
+    reg_iterations=(40, 20, 0),
+    grad_step=0.1,
+    flow_sigma=3.0,
+    total_sigma=0.0,
+    random_seed=1,
+)
+
+# ANTs images are float32; pair codes must stay exactly representable
+MAX_FUSED_LABEL = 2 ** 24
+
+DEFAULT_BACKEND = "fireants" if os.getenv("NEURO_USE_FIREANTS") == "1" else "ants"
+
+FIREANTS_PARAMS = dict(
+    scales=[4, 2, 1],
+    affine_iterations=[200, 100, 50],
+    syn_iterations=[100, 50, 25],
+    cc_kernel_size=5,
+)
+
+# Optional GPU registration backend
+FIREANTS_AVAILABLE = False
+if DEFAULT_BACKEND == "fireants":
+    try:
+        import torch
+        from fireants.io import Image as FireImage, BatchedImages
+        from fireants.registration import AffineRegistration, SyNRegistration
+        FIREANTS_AVAILABLE = torch.cuda.is_available()
+    except ImportError:
+        pass
+
+
+# -----------------------------
+# REFERENCE IMAGES
+# -----------------------------
+@functools.lru_cache(maxsize=4)
+def _read(path_str: str):
+    """
+    Template and atlases are read-only references shared by every
+    session in this process; ants.registration and apply_transforms
+    never mutate their inputs, so the decoded images are reused.
+    """
+    return ants.image_read(path_str)
+
+
+# -----------------------------
+# FIREANTS BACKEND
+# -----------------------------
+def _register_fireants(t0_path: Path, mni_template_path: Path, output_dir: Path) -> dict:
+    """
+    Affine + SyN (MNI -> subject) on CUDA with FireANTs. The forward
+    warp is exported as an ANTs displacement field so the atlases go
+    through the same ants.apply_transforms path; shaped like the
+    ants.registration result the caller consumes.
+    """
+    fixed = BatchedImages([FireImage.load_file(str(t0_path), device="cuda")])
+    moving = BatchedImages([FireImage.load_file(str(mni_template_path), device="cuda")])
+
+    affine = AffineRegistration(
+        FIREANTS_PARAMS["scales"], FIREANTS_PARAMS["affine_iterations"],
+        fixed, moving,
+        optimizer="Adam", optimizer_lr=3e-3,
+        cc_kernel_size=FIREANTS_PARAMS["cc_kernel_size"]
+    )
+    affine.optimize(save_transformed=False)
+
+    syn = SyNRegistration(
+        scales=FIREANTS_PARAMS["scales"],
+        iterations=FIREANTS_PARAMS["syn_iterations"],
+        fixed_images=fixed,
+        moving_images=moving,
+        optimizer="Adam", optimizer_lr=0.5,
+        cc_kernel_size=FIREANTS_PARAMS["cc_kernel_size"],
+        init_affine=affine.get_affine_matrix().detach()
+    )
+    syn.optimize(save_transformed=False)
+
+    # Written under its final name; the transform-copy step leaves it in place
+    warp_path = output_dir / "mni_to_subject_fwd_0.nii.gz"
+    syn.save_as_ants_transforms([str(warp_path)])
+
+    return {"fwdtransforms": [str(warp_path)], "invtransforms": []}
+
+
+# -----------------------------
+# ATLAS FUSION
+# -----------------------------
+def _same_geometry(a, b) -> bool:
+    return (
+        a.shape == b.shape
+        and np.allclose(a.spacing, b.spacing)
+        and np.allclose(a.origin, b.origin)
+        and np.allclose(a.direction, b.direction)
+    )
+
+
+def _warp_atlases(subject, atlas_cort, atlas_sub, fwd_transforms, logger):
+    """
+    Warp both label atlases with a single apply_transforms call.
+
+    The atlases overlap spatially, so each voxel is encoded as the pair
+    cort + sub * offset (offset > max cortical label), warped once with
+    nearest neighbour and split back with % and //. Falls back to two
+    warps when the atlases differ in geometry or the codes would not
+    fit in float32.
+    """
+    cort = np.rint(atlas_cort.numpy()).astype(np.int64)
+    sub = np.rint(atlas_sub.numpy()).astype(np.int64)
+
+    offset = int(cort.max()) + 1
+    fusable = (
+        _same_geometry(atlas_cort, atlas_sub)
+        and cort.min() >= 0 and sub.min() >= 0
+        and (int(sub.max()) + 1) * offset <= MAX_FUSED_LABEL
+    )
+
+    if not fusable:
+        logger.info("Atlases not fusable; warping separately...")
+        return tuple(
+            ants.apply_transforms(
+                fixed=subject,
+                moving=atlas,
+                transformlist=fwd_transforms,
+                interpolator="nearestNeighbor"
+            )
+            for atlas in (atlas_cort, atlas_sub)
+        )
+
+    fused = atlas_cort.new_image_like((cort + sub * offset).astype(np.float32))
+
+    warped = ants.apply_transforms(
+        fixed=subject,
+        moving=fused,
+        transformlist=fwd_transforms,
+        interpolator="nearestNeighbor"
+    )
+
+    codes = np.rint(warped.numpy()).astype(np.int64)
+    warped_cort = warped.new_image_like((codes % offset).astype(np.float32))
+    warped_sub = warped.new_image_like((codes // offset).astype(np.float32))
+    return warped_cort, warped_sub
 
 
 # -----------------------------
@@ -31,10 +188,14 @@ def register_atlas_to_subject(
     atlas_subcortical_path: Path,
     output_dir: Path,
     logger: logging.Logger,
+    backend: str = DEFAULT_BACKEND,
 ):
     """
     Register MNI template to subject T0 space,
     then warp atlas labels into subject space.
+
+    backend="fireants" registers on the GPU when FireANTs and CUDA are
+    available and falls back to ANTs otherwise.
     """
 
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -43,17 +204,27 @@ def register_atlas_to_subject(
     subject = ants.image_read(str(t0_path))
 
     logger.info("Loading MNI template...")
-    mni = ants.image_read(str(mni_template_path))
+    mni = _read(str(mni_template_path))
 
-    logger.info("Running antsRegistrationSyNQuick[s] (MNI -> Subject)...")
+    if backend == "fireants" and not FIREANTS_AVAILABLE:
+        logger.warning("FireANTs or CUDA unavailable; using ANTs.")
+        backend = "ants"
 
     start_time = time.time()
 
-    registration = ants.registration(
-        fixed=subject,
-        moving=mni,
-        type_of_transform="antsRegistrationSyNQuick[s]"
-    )
+    if backend == "fireants":
+        logger.info("Running FireANTs affine + SyN on CUDA (MNI -> Subject)...")
+        registration = _register_fireants(t0_path, mni_template_path, output_dir)
+    else:
+        logger.info("Running affine + SyN at 2 mm (MNI -> Subject)...")
+
+        # Transforms live in physical space, so the ones estimated on the
+        # 2 mm copies apply unchanged to the full-resolution subject grid.
+        registration = ants.registration(
+            fixed=ants.resample_image(subject, REGISTRATION_SPACING_MM, use_voxels=False),
+            moving=ants.resample_image(mni, REGISTRATION_SPACING_MM, use_voxels=False),
+            **REGISTRATION_PARAMS
+        )
 
     runtime_minutes = (time.time() - start_time) / 60.0
     logger.info(f"Registration completed in {runtime_minutes:.2f} minutes")
@@ -86,7 +257,8 @@ def register_atlas_to_subject(
         else:
             dest = output_dir / f"mni_to_subject_fwd_{i}{tf_path.suffix}"
 
-        shutil.copy2(tf_path, dest)
+        if tf_path.resolve() != dest.resolve():
+            shutil.copy2(tf_path, dest)
         logger.info(f"Saved forward transform: {dest.name}")
 
         new_fwd.append(str(dest))
@@ -119,36 +291,27 @@ def register_atlas_to_subject(
     # Warp Atlas Labels
     # -----------------------------
 
-    logger.info("Warping cortical atlas...")
-    atlas_cort = ants.image_read(str(atlas_cortical_path))
+    logger.info("Warping cortical and subcortical atlases...")
+    atlas_cort = _read(str(atlas_cortical_path))
+    atlas_sub = _read(str(atlas_subcortical_path))
 
-    warped_cort = ants.apply_transforms(
-        fixed=subject,
-        moving=atlas_cort,
-        transformlist=fwd_transforms,
-        interpolator="nearestNeighbor"
+    warped_cort, warped_sub = _warp_atlases(
+        subject, atlas_cort, atlas_sub, fwd_transforms, logger
     )
 
-    cort_out = output_dir / "atlas_cortical_in_subject.nii.gz"
+    # Uncompressed: step 2 re-reads these at once (and memory-maps them),
+    # so gzip would cost a compress and a decompress for nothing
+    cort_out = output_dir / "atlas_cortical_in_subject.nii"
     ants.image_write(warped_cort, str(cort_out))
 
-    logger.info("Warping subcortical atlas...")
-    atlas_sub = ants.image_read(str(atlas_subcortical_path))
-
-    warped_sub = ants.apply_transforms(
-        fixed=subject,
-        moving=atlas_sub,
-        transformlist=fwd_transforms,
-        interpolator="nearestNeighbor"
-    )
-
-    sub_out = output_dir / "atlas_subcortical_in_subject.nii.gz"
+    sub_out = output_dir / "atlas_subcortical_in_subject.nii"
     ants.image_write(warped_sub, str(sub_out))
 
     logger.info("Atlas registration complete.")
 
     return {
         "runtime_minutes": runtime_minutes,
+        "backend": backend,
         "threads": DEFAULT_THREADS,
         "cortical_atlas": str(cort_out),
         "subcortical_atlas": str(sub_out),
@@ -3,11 +3,156 @@ STEP 2 — ROI Extraction & Annualized Jacobian Metrics
 Dual-atlas aware, QA-hardened implementation
 """
 
-import nibabel as nib
+import hashlib
 import numpy as np
 import json
 from pathlib import Path
 import logging
+from typing import Any, Dict, Optional
+
+from Modules.nifti_io import load_nifti
+
+# Optional single-pass kernel for atlases with many ROIs
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+NUMBA_MIN_ROIS = 32
+
+if numba is not None:
+    @njit(parallel=True, cache=True)
+    def _label_sums_numba(atlas_flat, jac_flat, n_labels, n_chunks):
+        # One private row per chunk: no two threads touch the same slot
+        sums = np.zeros((n_chunks, n_labels))
+        counts = np.zeros((n_chunks, n_labels), np.int64)
+        chunk = (atlas_flat.size + n_chunks - 1) // n_chunks
+        for c in prange(n_chunks):
+            for i in range(c * chunk, min((c + 1) * chunk, atlas_flat.size)):
+                label = atlas_flat[i]
+                sums[c, label] += jac_flat[i]
+                counts[c, label] += 1
+        return sums, counts
+
+
+def _load_f32(path: Path) -> np.ndarray:
+    # Read straight into float32 instead of get_fdata()'s float64 copy
+    return np.asarray(load_nifti(path).dataobj, dtype=np.float32)
+
+
+def _load_labels(path: Path) -> np.ndarray:
+    # Atlas labels are integral; int32 is a quarter of float64
+    return np.asarray(load_nifti(path).dataobj, dtype=np.int32)
+
+
+def _label_tables(atlas: np.ndarray, jac_flat: np.ndarray, name: str, use_numba: bool = False):
+    """
+    Per-label Jacobian sums and voxel counts in one pass over the atlas.
+    Index i of each table holds the totals for label i.
+    """
+    atlas_flat = atlas.reshape(-1)
+    if atlas_flat.min() < 0:
+        raise ValueError(f"{name} atlas contains negative labels.")
+
+    minlength = int(atlas_flat.max()) + 1
+
+    if use_numba and numba is not None:
+        sums, counts = _label_sums_numba(atlas_flat, jac_flat, minlength, numba.get_num_threads())
+        return sums.sum(axis=0), counts.sum(axis=0)
+
+    sums = np.bincount(atlas_flat, weights=jac_flat, minlength=minlength)
+    counts = np.bincount(atlas_flat, minlength=minlength)
+    return sums, counts
+
+
+SUBCORTICAL_ROIS = ["hippocampus", "ventricles"]
+
+
+def build_roi_index(
+    cortical: np.ndarray,
+    subcortical: np.ndarray,
+    roi_labels: Dict[str, list],
+    affine: Optional[np.ndarray] = None
+) -> Dict[str, Any]:
+    """
+    Flat voxel indices of every ROI, for reuse across Jacobians sampled
+    on the same atlas grid. The grid (shape, affine) is recorded so a
+    Jacobian on a different grid is rejected rather than gathered.
+    """
+    if cortical.shape != subcortical.shape:
+        raise ValueError("Cortical and subcortical atlas dimensions do not match.")
+
+    flats = {
+        "cortical": cortical.reshape(-1),
+        "subcortical": subcortical.reshape(-1)
+    }
+    # One label histogram per atlas, shared by every ROI routed to it
+    label_counts = {k: np.bincount(v[v >= 0]) for k, v in flats.items()}
+
+    indices = {}
+    for roi_name, labels in roi_labels.items():
+        atlas = "subcortical" if roi_name in SUBCORTICAL_ROIS else "cortical"
+        counts = label_counts[atlas]
+        for label in labels:
+            if not 0 <= label < len(counts) or counts[label] == 0:
+                raise ValueError(
+                    f"Label {label} for ROI '{roi_name}' not found in corresponding atlas."
+                )
+
+        indices[roi_name] = np.flatnonzero(np.isin(flats[atlas], labels))
+
+    return {
+        "shape": tuple(cortical.shape),
+        "affine": None if affine is None else np.asarray(affine, dtype=np.float64),
+        "indices": indices
+    }
+
+
+def load_roi_index(
+    cortical_atlas_path: Path,
+    subcortical_atlas_path: Path,
+    roi_config_path: Path,
+    cache_dir: Path
+) -> Dict[str, Any]:
+    """
+    build_roi_index backed by an .npz in cache_dir, keyed by a checksum
+    of both atlases and the ROI configuration.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for p in (cortical_atlas_path, subcortical_atlas_path, roi_config_path):
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 22), b""):
+                h.update(chunk)
+    cache_path = Path(cache_dir) / f"roi_index_v2_{h.hexdigest()}.npz"
+
+    if cache_path.exists():
+        with np.load(cache_path) as npz:
+            return {
+                "shape": tuple(int(d) for d in npz["__shape__"]),
+                "affine": npz["__affine__"],
+                "indices": {k: npz[k] for k in npz.files if not k.startswith("__")}
+            }
+
+    with open(roi_config_path) as f:
+        roi_labels = json.load(f)
+
+    cortical_img = load_nifti(cortical_atlas_path)
+    roi_index = build_roi_index(
+        np.asarray(cortical_img.dataobj, dtype=np.int32),
+        _load_labels(subcortical_atlas_path),
+        roi_labels,
+        affine=cortical_img.affine
+    )
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        cache_path,
+        __shape__=np.asarray(roi_index["shape"], dtype=np.int64),
+        __affine__=roi_index["affine"],
+        **roi_index["indices"]
+    )
+    return roi_index
 
 
 def compute_roi_metrics(
@@ -16,41 +161,48 @@ def compute_roi_metrics(
     subcortical_atlas_path: Path,
     roi_config_path: Path,
     interval_days: float,
-    logger: logging.Logger
+    logger: logging.Logger,
+    roi_index: Optional[Dict[str, Any]] = None
 ):
+    """
+    With roi_index (see load_roi_index), the atlases are not read and
+    each ROI mean is a gather over its precomputed voxel indices.
+    """
 
     # -------------------------------------------------
     # Load Data
     # -------------------------------------------------
 
     logger.info("Loading Jacobian map...")
-    jac = nib.load(str(jacobian_path)).get_fdata()
+    jac = _load_f32(jacobian_path)
 
-    logger.info("Loading warped cortical atlas...")
-    cortical = nib.load(str(cortical_atlas_path)).get_fdata()
+    if roi_index is None:
+        logger.info("Loading warped cortical atlas...")
+        cortical = _load_labels(cortical_atlas_path)
 
-    logger.info("Loading warped subcortical atlas...")
-    subcortical = nib.load(str(subcortical_atlas_path)).get_fdata()
+        logger.info("Loading warped subcortical atlas...")
+        subcortical = _load_labels(subcortical_atlas_path)
 
     # -------------------------------------------------
     # Integrity Checks
     # -------------------------------------------------
 
-    if jac.shape != cortical.shape:
-        raise ValueError("Jacobian and cortical atlas dimensions do not match.")
+    if roi_index is None:
+        if jac.shape != cortical.shape:
+            raise ValueError("Jacobian and cortical atlas dimensions do not match.")
 
-    if jac.shape != subcortical.shape:
-        raise ValueError("Jacobian and subcortical atlas dimensions do not match.")
+        if jac.shape != subcortical.shape:
+            raise ValueError("Jacobian and subcortical atlas dimensions do not match.")
 
-# -------------------------------------------------
-    # Integrity Checks
-    # -------------------------------------------------
-
-    if jac.shape != cortical.shape:
-        raise ValueError("Jacobian and cortical atlas dimensions do not match.")
+    else:
+        if tuple(jac.shape) != tuple(roi_index["shape"]):
+            raise ValueError("ROI index atlas and Jacobian dimensions do not match.")
 
-    if jac.shape != subcortical.shape:
-        raise ValueError("Jacobian and subcortical atlas dimensions do not match.")
+        index_affine = roi_index.get("affine")
+        if index_affine is not None and not np.allclose(
+            load_nifti(jacobian_path).affine, index_affine, atol=1e-3
+        ):
+            logger.warning("ROI index atlas and Jacobian affines differ.")
 
     # FIX: Enforce minimum clinical interval to prevent ZeroDivisionError 
     # and noise amplification (e.g., annualizing a 1-day change).
@@ -61,8 +213,9 @@ def compute_roi_metrics(
             f"Minimum {MIN_INTERVAL_DAYS} days required."
         )
 
-    # Enforce diffeomorphic deformation
-    if np.any(jac <= 0):
+    # Enforce diffeomorphic deformation (min reduction, no bool mask)
+    jac_min = float(jac.min())
+    if jac_min <= 0:
         raise ValueError("Non-diffeomorphic Jacobian detected. Upstream failure.")
 
     # -------------------------------------------------
@@ -83,7 +236,7 @@ def compute_roi_metrics(
     subcortical_labels_all = []
 
     for roi_name, labels in roi_labels.items():
-        if roi_name in ["hippocampus", "ventricles"]:
+        if roi_name in SUBCORTICAL_ROIS:
             subcortical_labels_all.extend(labels)
         else:
             cortical_labels_all.extend(labels)
@@ -99,6 +252,15 @@ def compute_roi_metrics(
     # -------------------------------------------------
 
     interval_years = interval_days / 365.25
+    jac_flat = jac.reshape(-1)
+
+    if roi_index is None:
+        # Fine parcellations: one fused parallel pass beats two bincounts
+        use_numba = len(roi_labels) > NUMBA_MIN_ROIS
+        tables = {
+            "cortical": _label_tables(cortical, jac_flat, "Cortical", use_numba),
+            "subcortical": _label_tables(subcortical, jac_flat, "Subcortical", use_numba)
+        }
     results = {}
 
     required_rois = [
@@ -111,23 +273,27 @@ def compute_roi_metrics(
 
     for roi_name, labels in roi_labels.items():
 
-        # Route ROI to correct atlas
-        if roi_name in ["hippocampus", "ventricles"]:
-            atlas_data = subcortical
-        else:
-            atlas_data = cortical
+        if roi_index is not None:
+            idx = roi_index["indices"][roi_name]
+            voxel_count = int(idx.size)
+            jac_sum = float(jac_flat[idx].sum(dtype=np.float64))
 
-        unique_labels = np.unique(atlas_data)
-
-        # Validate labels exist in atlas
-        for label in labels:
-            if label not in unique_labels:
-                raise ValueError(
-                    f"Label {label} for ROI '{roi_name}' not found in corresponding atlas."
-                )
-
-        mask = np.isin(atlas_data, labels)
-        voxel_count = int(mask.sum())
+        else:
+            # Route ROI to correct atlas
+            if roi_name in SUBCORTICAL_ROIS:
+                sums, counts = tables["subcortical"]
+            else:
+                sums, counts = tables["cortical"]
+
+            # Validate labels exist in atlas
+            for label in labels:
+                if not 0 <= label < len(counts) or counts[label] == 0:
+                    raise ValueError(
+                        f"Label {label} for ROI '{roi_name}' not found in corresponding atlas."
+                    )
+
+            voxel_count = int(counts[labels].sum())
+            jac_sum = float(sums[labels].sum())
 
         if roi_name in required_rois and voxel_count == 0:
             raise ValueError(f"Required ROI '{roi_name}' has empty mask.")
@@ -136,9 +302,7 @@ def compute_roi_metrics(
             logger.warning(f"{roi_name} mask empty.")
             continue
 
-        values = jac[mask]
-
-        mean_jac = float(np.mean(values))
+        mean_jac = jac_sum / voxel_count
         percent_change_total = (mean_jac - 1.0) * 100.0
         percent_change_per_year = percent_change_total / interval_years
 
@@ -4,15 +4,22 @@ Depends on:
 - STEP 2 ROI metrics output structure
 """
 
+import functools
 import json
 from pathlib import Path
 import logging
 
+import numpy as np
 
-def select_age_bin(age: int, normative_data: dict):
-    # Parse all bins into (low, high, key) tuples
+
+@functools.lru_cache(maxsize=8)
+def _parse_bins(keys: tuple):
+    """
+    Parse "low-high" bin keys once into lows/highs arrays sorted by low,
+    plus the matching key list. Malformed keys are skipped.
+    """
     bins = []
-    for key in normative_data.keys():
+    for key in keys:
         try:
             low, high = map(int, key.split("-"))
             bins.append((low, high, key))
@@ -22,24 +29,31 @@ def select_age_bin(age: int, normative_data: dict):
     # Sort bins by starting age
     bins.sort(key=lambda x: x[0])
 
-    if not bins:
+    lows = np.array([b[0] for b in bins], dtype=np.int32)
+    highs = np.array([b[1] for b in bins], dtype=np.int32)
+    return lows, highs, [b[2] for b in bins]
+
+
+def select_age_bin(age: int, normative_data: dict):
+    lows, highs, keys = _parse_bins(tuple(normative_data.keys()))
+
+    if not keys:
         raise ValueError("Normative data is empty or invalid.")
 
-    # 1. Try to find the exact correct bin
-    for low, high, key in bins:
-        if low <= age < high:
-            return key, normative_data[key]
+    # 1. Binary search for the bin starting at or below age
+    idx = int(np.searchsorted(lows, age, side="right")) - 1
 
     # 2. Clamp Logic (Nearest Neighbor)
-    
+
     # If patient is younger than the youngest bin, use the first bin
-    if age < bins[0][0]:
-        target_key = bins[0][2]
-        return target_key, normative_data[target_key]
+    if idx < 0:
+        target_key = keys[0]
+    elif age < highs[idx]:
+        target_key = keys[idx]
+    else:
+        # Past the bin's end (older than the oldest bin): use the last bin
+        target_key = keys[-1]
 
-    # If patient is older than the oldest bin, use the last bin
-    # (The loop above failed, so age must be >= highest bin's end)
-    target_key = bins[-1][2]
     return target_key, normative_data[target_key]
 
 
@@ -105,29 +119,32 @@ def compute_z_scores(
     # Z-Score Computation
     # -----------------------------
 
-    z_results = {}
+    n = len(required_rois)
+    annual = np.fromiter(
+        (roi_metrics[roi]["percent_change_per_year"] for roi in required_rois),
+        dtype=np.float64, count=n
+    )
+    mean = np.fromiter((age_norm[roi]["mean"] for roi in required_rois), dtype=np.float64, count=n)
+    std = np.fromiter((age_norm[roi]["std"] for roi in required_rois), dtype=np.float64, count=n)
 
-    for roi in required_rois:
+    zero_std = np.flatnonzero(std == 0)
+    if zero_std.size:
+        raise ValueError(f"Standard deviation for {required_rois[zero_std[0]]} is zero.")
 
-        values = roi_metrics[roi]
+    z = (annual - mean) / std
 
-        annual = values["percent_change_per_year"]
-        mean = age_norm[roi]["mean"]
-        std = age_norm[roi]["std"]
-
-        if std == 0:
-            raise ValueError(f"Standard deviation for {roi} is zero.")
+    z_results = {}
 
-        z = (annual - mean) / std
+    for i, roi in enumerate(required_rois):
 
         z_results[roi] = {
-            "annual_percent_change": annual,
-            "normative_mean": mean,
-            "normative_std": std,
-            "z_score": float(z)
+            "annual_percent_change": roi_metrics[roi]["percent_change_per_year"],
+            "normative_mean": age_norm[roi]["mean"],
+            "normative_std": age_norm[roi]["std"],
+            "z_score": float(z[i])
         }
 
-        logger.info(f"{roi}: Z={z:.3f}")
+        logger.info(f"{roi}: Z={z[i]:.3f}")
 
     return {
         "age": age,
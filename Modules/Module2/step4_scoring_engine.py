@@ -6,6 +6,29 @@ Depends on:
 
 import logging
 
+import numpy as np
+
+
+# -----------------------------
+# Z-Score Rule Table
+# (roi, direction, threshold, weight, rationale)
+# direction -1 fires below the threshold, +1 above it
+# -----------------------------
+
+_Z_RULES = (
+    ("hippocampus", -1, -2.0, 2, "Hippocampal atrophy Z < -2.0"),
+    ("entorhinal_cortex", -1, -1.5, 1, "Entorhinal atrophy Z < -1.5"),
+    ("temporal_lobe", -1, -1.5, 1, "Temporal lobe atrophy Z < -1.5"),
+    ("parietal_lobe", -1, -1.5, 1, "Parietal lobe atrophy Z < -1.5"),
+    ("ventricles", 1, 2.0, 1, "Ventricular expansion Z > +2.0"),
+)
+
+_RULE_ROIS = [r[0] for r in _Z_RULES]
+_RULE_SIGN = np.array([r[1] for r in _Z_RULES], dtype=np.float64)
+_RULE_THR = np.array([r[2] for r in _Z_RULES], dtype=np.float64)
+_RULE_WEIGHT = np.array([r[3] for r in _Z_RULES], dtype=np.int64)
+_RULE_TEXT = [r[4] for r in _Z_RULES]
+
 
 def classify_progression(step3_output: dict, logger: logging.Logger):
 
@@ -43,40 +66,22 @@ def classify_progression(step3_output: dict, logger: logging.Logger):
     # Extract Values
     # -----------------------------
 
-    hip_z = float(z_scores["hippocampus"]["z_score"])
-    ent_z = float(z_scores["entorhinal_cortex"]["z_score"])
-    temp_z = float(z_scores["temporal_lobe"]["z_score"])
-    par_z = float(z_scores["parietal_lobe"]["z_score"])
-    vent_z = float(z_scores["ventricles"]["z_score"])
+    z = np.fromiter(
+        (z_scores[roi]["z_score"] for roi in _RULE_ROIS),
+        dtype=np.float64,
+        count=len(_RULE_ROIS)
+    )
 
     hip_rate = float(z_scores["hippocampus"]["annual_percent_change"])
 
-    score = 0
-    rationale = []
-
     # -----------------------------
     # Core Alzheimer’s Pattern Rules
     # -----------------------------
 
-    if hip_z < -2.0:
-        score += 2
-        rationale.append("Hippocampal atrophy Z < -2.0")
-
-    if ent_z < -1.5:
-        score += 1
-        rationale.append("Entorhinal atrophy Z < -1.5")
-
-    if temp_z < -1.5:
-        score += 1
-        rationale.append("Temporal lobe atrophy Z < -1.5")
-
-    if par_z < -1.5:
-        score += 1
-        rationale.append("Parietal lobe atrophy Z < -1.5")
+    flags = _RULE_SIGN * z > _RULE_SIGN * _RULE_THR
 
-    if vent_z > 2.0:
-        score += 1
-        rationale.append("Ventricular expansion Z > +2.0")
+    score = int(_RULE_WEIGHT @ flags)
+    rationale = [text for text, hit in zip(_RULE_TEXT, flags) if hit]
 
     # -----------------------------
     # Aggressive Atrophy Rate Rule
@@ -0,0 +1,18 @@
+"""
+ITK threading default shared by every entry point that loads ANTs.
+
+Import this before `ants`. ITK reads ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS
+once, when its thread pool first initialises; setting the variable after
+that is a no-op. Physical cores minus one avoids hyper-thread
+oversubscription of the memory-bound SyN kernels. An explicit value in
+the environment always wins.
+"""
+
+import os
+
+import psutil
+
+_physical = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(max(1, _physical - 1)))
+
+ITK_THREADS = int(os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"])
@@ -0,0 +1,48 @@
+"""
+Shared NIfTI I/O helpers for Module 1 and Module 2.
+
+Decompresses gzip'd volumes once so the many downstream readers
+(HD-BET, N4, ANTs, nibabel) skip re-streaming the gzip on every read,
+and memory-maps the uncompressed result for nibabel readers.
+"""
+
+import gzip
+import shutil
+import subprocess
+from pathlib import Path
+
+import nibabel as nib
+
+COPY_BUFFER_BYTES = 4 * 1024 * 1024
+
+
+def decompress_nifti(src: Path, dest_dir: Path) -> Path:
+    """
+    Unpack a .nii.gz into dest_dir and return the .nii path.
+    Non-gzip inputs are returned unchanged.
+    """
+    src = Path(src)
+    if not src.name.endswith(".nii.gz"):
+        return src
+
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    dest = dest_dir / src.name[:-len(".gz")]
+
+    pigz = shutil.which("pigz")
+    if pigz:
+        with dest.open("wb") as f_out:
+            subprocess.run([pigz, "-dc", str(src)], stdout=f_out, check=True)
+    else:
+        with gzip.open(src, "rb") as f_in, dest.open("wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, length=COPY_BUFFER_BYTES)
+
+    return dest
+
+
+def load_nifti(path: Path):
+    """
+    nibabel image backed by a memory map of the file, so repeated reads
+    of the same volume share the page cache. Gzip'd files fall back to
+    a normal read.
+    """
+    return nib.load(str(path), mmap=True)
@@ -1,15 +1,24 @@
+# Pin ITK threading before backend pulls in ants
+import Modules._ants_env  # noqa: F401
+
+import asyncio
+import json
 import uuid
 import shutil
 import io
 import os
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, Any, cast
+from typing import Optional, Any
 
 import numpy as np
 import nibabel as nib
 import numpy.typing as npt
-import matplotlib.pyplot as plt
+import matplotlib
+from PIL import Image
 
 from fastapi import (
     FastAPI,
@@ -28,7 +37,7 @@ from fastapi.responses import (
 from fastapi.staticfiles import StaticFiles
 
 # Assuming this exists in your environment
-from backend import run_full_pipeline
+from backend import run_pipeline_job, init_pipeline_worker
 from fastapi.middleware.cors import CORSMiddleware
 # ============================================================
 # FastAPI App Init
@@ -49,6 +58,22 @@ SESSIONS_DIR = BASE_DIR / "sessions"
 
 SESSIONS_DIR.mkdir(exist_ok=True)
 
+# Registration and MedGemma run here, off the event loop. One worker by
+# default: the model is loaded once per worker process, by the
+# initializer (or lazily at Step 6 if that load failed). Spawn, not fork: a forked child would inherit this
+# process's threads, locks and any CUDA state.
+PIPELINE_EXECUTOR = ProcessPoolExecutor(
+    max_workers=int(os.getenv("PIPELINE_WORKERS", "1")),
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=init_pipeline_worker
+)
+
+@app.on_event("startup")
+def preload_pipeline_worker():
+    # Start a worker (and its model load) at boot instead of on the first run
+    if os.getenv("PRELOAD_MEDGEMMA") == "1":
+        PIPELINE_EXECUTOR.submit(int)
+
 # Serve sessions folder for browser access
 app.mount(
     "/sessions",
@@ -65,9 +90,12 @@ def generate_session_id() -> str:
     short_uuid = str(uuid.uuid4())[:8]
     return f"SESSION_{timestamp}_{short_uuid}"
 
+UPLOAD_BUFFER_BYTES = 4 * 1024 * 1024
+
 def save_upload(file: UploadFile, destination: Path):
-    with destination.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Large chunks, unbuffered writes: a few dozen syscalls per volume
+    with destination.open("wb", buffering=0) as buffer:
+        shutil.copyfileobj(file.file, buffer, length=UPLOAD_BUFFER_BYTES)
 
 # ============================================================
 # RUN PIPELINE ENDPOINT
@@ -79,7 +107,8 @@ async def run_pipeline(
     t1_file: UploadFile = File(...),
     age: int = Form(...),
     sex: str = Form(...),
-    interval_days: float = Form(...)
+    interval_days: float = Form(...),
+    wait: bool = Form(True)
 ):
     try:
         session_id = generate_session_id()
@@ -90,16 +119,28 @@ async def run_pipeline(
         t0_path = input_dir / "T0.nii.gz"
         t1_path = input_dir / "T1.nii.gz"
 
-        save_upload(t0_file, t0_path)
-        save_upload(t1_file, t1_path)
+        # Copy off the event loop so other requests keep being served
+        await asyncio.gather(
+            asyncio.to_thread(save_upload, t0_file, t0_path),
+            asyncio.to_thread(save_upload, t1_file, t1_path)
+        )
 
-        result = run_full_pipeline(
-            session_dir=session_dir,
-            age=age,
-            sex=sex,
-            interval_days=interval_days
+        job = asyncio.get_running_loop().run_in_executor(
+            PIPELINE_EXECUTOR,
+            functools.partial(run_pipeline_job, session_dir, age, sex, interval_days)
         )
 
+        if not wait:
+            # Failures are recorded in status.json; mark the exception retrieved
+            job.add_done_callback(lambda f: f.exception())
+            return JSONResponse({
+                "status": "accepted",
+                "session_id": session_id,
+                "session_dir": str(session_dir).replace("\\", "/")
+            }, status_code=202)
+
+        result = await job
+
         return JSONResponse({
             "status": "success",
             "session_id": session_id,
@@ -110,6 +151,22 @@ async def run_pipeline(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ============================================================
+# STATUS ENDPOINT
+# ============================================================
+
+@app.get("/status/{session_id}")
+def pipeline_status(session_id: str):
+    session_dir = SESSIONS_DIR / session_id
+    if not session_dir.exists():
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    status_path = session_dir / "status.json"
+    if not status_path.exists():
+        return JSONResponse({"status": "pending"})
+
+    return JSONResponse(json.loads(status_path.read_text()))
+
 # ============================================================
 # NIFTI FILE RESOLUTION
 # ============================================================
@@ -138,6 +195,14 @@ def load_nifti_for_session(session_id: str, which: str) -> Optional[Path]:
             return matches[0]
     return None
 
+@functools.lru_cache(maxsize=32)
+def _open_nifti(path_str: str, mtime_ns: int) -> Any:
+    # mtime in the key so a rewritten file is reopened
+    return nib.load(path_str)
+
+def open_nifti(path: Path) -> Any:
+    return _open_nifti(str(path), path.stat().st_mtime_ns)
+
 # ============================================================
 # SLICE INFO ENDPOINT
 # ============================================================
@@ -152,8 +217,7 @@ def slice_info(session: str):
     for key in ["t0", "t1", "warped", "jacobian"]:
         path = load_nifti_for_session(session, key)
         if path:
-            # Cast to Any to prevent Pylance "load is not exported" / "get_data_shape" errors
-            img: Any = nib.load(str(path))
+            img = open_nifti(path)
             shape = tuple(int(x) for x in img.shape) # Use img.shape directly
             info[key] = {
                 "shape": shape,
@@ -168,29 +232,52 @@ def slice_info(session: str):
 # SLICE RENDERING
 # ============================================================
 
-def extract_slice(data: npt.NDArray[Any], plane: str, index: int) -> npt.NDArray[Any]:
-    if plane == "axial":
-        return np.rot90(data[:, :, index])
-    elif plane == "coronal":
-        return np.rot90(data[:, index, :])
-    elif plane == "sagittal":
-        return np.rot90(data[index, :, :])
-    else:
+PLANE_AXES = {"sagittal": 0, "coronal": 1, "axial": 2}
+
+def plane_slicer(plane: str, index: int) -> tuple:
+    if plane not in PLANE_AXES:
         raise ValueError("Invalid plane")
+    slicer: list = [slice(None)] * 3
+    slicer[PLANE_AXES[plane]] = index
+    return tuple(slicer)
 
-def render_png(slice_img: npt.NDArray[Any]) -> io.BytesIO:
-    vmin = np.percentile(slice_img, 2)
-    vmax = np.percentile(slice_img, 98)
+def read_plane(img: Any, slicer: tuple) -> npt.NDArray[np.float32]:
+    # Slicing the proxy reads only the requested plane from disk
+    return np.asarray(img.dataobj[slicer], dtype=np.float32)
+
+def extract_slice(img: Any, plane: str, index: int) -> npt.NDArray[Any]:
+    return np.rot90(read_plane(img, plane_slicer(plane, index)))
+
+def _slice_of(path: Path, plane: str, index: int) -> npt.NDArray[Any]:
+    return extract_slice(open_nifti(path), plane, index)
 
-    fig = plt.figure(figsize=(6, 6))
-    ax = fig.add_axes((0.0, 0.0, 1.0, 1.0))
+RENDER_SIZE = 600  # long side in pixels, as the old 6in @ 100dpi figure
+
+OVERLAY_ALPHA_256 = int(0.45 * 256)
+
+# 256-entry RGB table for the Jacobian overlay
+_BWR_LUT = (matplotlib.colormaps["bwr"](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+def to_uint8(slice_img: npt.NDArray[Any]) -> npt.NDArray[np.uint8]:
+    # 2nd-98th percentile window, one percentile pass
+    vmin, vmax = np.percentile(slice_img, (2, 98))
+    scaled = (slice_img - vmin) * (255.0 / (vmax - vmin + 1e-9))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+def render_png(slice_img: npt.NDArray[Any]) -> io.BytesIO:
+    # uint8 input (the RGB overlay) is already display-ready
+    u8 = slice_img if slice_img.dtype == np.uint8 else to_uint8(slice_img)
 
-    ax.imshow(slice_img, cmap="gray", vmin=vmin, vmax=vmax, origin="lower")
-    ax.axis("off")
+    # Flip rows to keep the origin="lower" orientation
+    img = Image.fromarray(np.ascontiguousarray(u8[::-1]))
+    scale = RENDER_SIZE / max(img.size)
+    img = img.resize(
+        (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+        Image.Resampling.NEAREST
+    )
 
     buf = io.BytesIO()
-    fig.savefig(buf, format="png", bbox_inches="tight", pad_inches=0)
-    plt.close(fig)
+    img.save(buf, format="PNG", compress_level=1)
     buf.seek(0)
     return buf
 
@@ -218,17 +305,15 @@ def slice_png(
             raise HTTPException(status_code=404, detail=f"{vol} not found")
 
 
-    # Use Any to bypass nibabel's inconsistent type stubs
-    img: Any = nib.load(str(path))
-    data = cast(npt.NDArray[np.float64], img.get_fdata())
+    img = open_nifti(path)
 
     # Ensure index is an integer and not None
     if plane == "axial":
-        max_idx = data.shape[2] - 1
+        max_idx = img.shape[2] - 1
     elif plane == "coronal":
-        max_idx = data.shape[1] - 1
+        max_idx = img.shape[1] - 1
     elif plane == "sagittal":
-        max_idx = data.shape[0] - 1
+        max_idx = img.shape[0] - 1
     else:
         raise HTTPException(status_code=400, detail="Invalid plane")
 
@@ -237,17 +322,15 @@ def slice_png(
 
 
     # Always define slice_img first
-    slice_img: npt.NDArray[Any] = extract_slice(data, plane, safe_index)
+    slice_img: npt.NDArray[Any] = _slice_of(path, plane, safe_index)
 
     # Jacobian overlay logic (proper expansion / contraction visualization)
     if overlay_jacobian:
         jac_path = load_nifti_for_session(session, "jacobian")
 
         if jac_path:
-            jac_img: Any = nib.load(str(jac_path))
-            jac_data = cast(npt.NDArray[np.float64], jac_img.get_fdata())
-
-            jac_slice = extract_slice(jac_data, plane, safe_index)
+            # Viewing the Jacobian itself: reuse the slice already read
+            jac_slice = slice_img if jac_path == path else _slice_of(jac_path, plane, safe_index)
 
             # Log transform improves visualization (medical standard)
             jac_log = np.log(jac_slice + 1e-6)
@@ -256,24 +339,16 @@ def slice_png(
             vmax = np.percentile(np.abs(jac_log), 98)
             vmin = -vmax
 
-            jac_norm = (jac_log - vmin) / (vmax - vmin + 1e-9)
-            jac_norm = np.clip(jac_norm, 0, 1)
-
-            cmap = plt.get_cmap("bwr")
-            jac_rgb = cmap(jac_norm)[:, :, :3]
+            jac_idx = np.clip((jac_log - vmin) * (255.0 / (vmax - vmin + 1e-9)), 0, 255)
+            jac_rgb = _BWR_LUT[jac_idx.astype(np.uint8)].astype(np.uint16)
 
             # Normalize base image
-            base_vmin = np.percentile(slice_img, 2)
-            base_vmax = np.percentile(slice_img, 98)
-
-            base_norm = (slice_img - base_vmin) / (base_vmax - base_vmin + 1e-9)
-            base_norm = np.clip(base_norm, 0, 1)
+            base_u8 = to_uint8(slice_img)[:, :, None].astype(np.uint16)
 
-            base_rgb = np.stack([base_norm] * 3, axis=-1)
+            # Fixed-point alpha blend in 1/256 steps
+            alpha = OVERLAY_ALPHA_256
 
-            alpha = 0.45
-
-            slice_img = (1 - alpha) * base_rgb + alpha * jac_rgb
+            slice_img = (((256 - alpha) * base_u8 + alpha * jac_rgb) >> 8).astype(np.uint8)
 
 
     buf = render_png(slice_img)
@@ -291,27 +366,22 @@ def compare_png(
     if t0_path is None or t1_path is None:
         raise HTTPException(status_code=404, detail="Missing T0 or T1")
 
-    t0_img: Any = nib.load(str(t0_path))
-    t1_img: Any = nib.load(str(t1_path))
+    if plane not in PLANE_AXES:
+        raise HTTPException(status_code=400, detail="Invalid plane")
 
-    t0 = cast(npt.NDArray[np.float64], t0_img.get_fdata())
-    t1 = cast(npt.NDArray[np.float64], t1_img.get_fdata())
+    t0 = open_nifti(t0_path)
+    t1 = open_nifti(t1_path)
 
-    if plane == "axial":
-        max_idx = t0.shape[2] - 1
-    elif plane == "coronal":
-        max_idx = t0.shape[1] - 1
-    else:
-        max_idx = t0.shape[0] - 1
+    max_idx = t0.shape[PLANE_AXES[plane]] - 1
 
     safe_index = index if index is not None else max_idx // 2
+    safe_index = max(0, min(safe_index, max_idx))
 
-    t0_slice = extract_slice(t0, plane, safe_index)
-    t1_slice = extract_slice(t1, plane, safe_index)
-
-    diff = t1_slice - t0_slice
+    # One plane from each volume, differenced before the single rotation
+    slicer = plane_slicer(plane, safe_index)
+    diff = read_plane(t1, slicer) - read_plane(t0, slicer)
 
-    buf = render_png(diff)
+    buf = render_png(np.rot90(diff))
 
     return StreamingResponse(buf, media_type="image/png")
 
@@ -320,7 +390,7 @@ def max_slice(session: str, vol: str, plane: str):
 
     path = load_nifti_for_session(session, vol)
 
-    img = nib.load(str(path))
+    img = open_nifti(path)
     shape = img.shape
 
     if plane == "axial":
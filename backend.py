@@ -1,8 +1,14 @@
 # backend.py
 
+# Must precede any module that imports ants
+import Modules._ants_env  # noqa: F401
+
+import json
+import logging
+import os
 from pathlib import Path
 from Modules.Module1.Module1_orchestrator import run_module1
-from Modules.Module2.Module2_orchestrator import run_module2
+from Modules.Module2.Module2_orchestrator import run_module2, get_medgemma_client
 
 
 def run_full_pipeline(session_dir: Path, age: int, sex: str, interval_days: float):
@@ -50,3 +56,40 @@ def run_full_pipeline(session_dir: Path, age: int, sex: str, interval_days: floa
     )
 
     return result
+
+
+def init_pipeline_worker():
+    """
+    Process-pool initializer: MedGemma is loaded in the worker that runs
+    Step 6, never in the API process that only dispatches jobs.
+    A failed load is only logged; an initializer that raises breaks the
+    whole pool, and Step 6 retries the load lazily via the singleton.
+    """
+    logger = logging.getLogger("MedGemmaClient")
+    try:
+        get_medgemma_client(logger)
+    except Exception:
+        logger.exception("MedGemma preload failed; Step 6 will retry the load")
+
+
+def write_status(session_dir: Path, status: dict):
+    # tmp + rename so a poller never reads a half-written file
+    tmp = session_dir / "status.json.tmp"
+    tmp.write_text(json.dumps(status))
+    os.replace(tmp, session_dir / "status.json")
+
+
+def run_pipeline_job(session_dir: Path, age: int, sex: str, interval_days: float):
+    """
+    run_full_pipeline with its progress recorded in session_dir/status.json,
+    for callers that run it in a worker process and poll for completion.
+    """
+    write_status(session_dir, {"status": "running"})
+    try:
+        result = run_full_pipeline(session_dir, age, sex, interval_days)
+    except Exception as e:
+        write_status(session_dir, {"status": "failed", "error": str(e)})
+        raise
+
+    write_status(session_dir, {"status": "success", "result": result})
+    return result